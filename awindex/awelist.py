@@ -1,15 +1,13 @@
 import re
-import requests
-import json
 import logging
 import mistletoe
 from mistletoe.markdown_renderer import MarkdownRenderer, BaseRenderer, block_token, span_token
 from .models import IndexRecord, SourceResults, Awesome
-from .utils import cache, CACHE_FOR_SECONDS
+from .utils import fetch_url
 
 log = logging.getLogger(__name__)
 
-class JsonlRenderer(BaseRenderer):
+class RecordRenderer(BaseRenderer):
     def __init__(
         self,
         *extras,
@@ -27,14 +25,15 @@ class JsonlRenderer(BaseRenderer):
         # Internal tracking state:
         self.headings = [] 
         self.item = { 'meta': {} }
+        self.items = []
         self.keep_text = False
         self.in_item = False
     
     def render_heading(self, token: block_token.Heading) -> str:
         self.keep_text = True
         rendered = self.render_inner(token)
-        self.headings.insert( token.level - 1, rendered.strip() )
-        self.headings = self.headings[0:token.level]
+        del self.headings[token.level - 1:]
+        self.headings.append(rendered.strip())
         self.item['sections'] = [ " > ".join(self.headings[1:]) ]
         self.keep_text = False
         return ""
@@ -46,10 +45,20 @@ class JsonlRenderer(BaseRenderer):
         self.in_item = True
         self.keep_text = True
         self.item['url'] = None
-        self.item['title']  = self.render_inner(token)
+        title = self.render_inner(token)
         self.keep_text = False
         self.in_item = False
-        return json.dumps(self.item)+"\n"
+        self.items.append((self.item['url'], title, self.item.get('sections', None), self.item['meta']))
+        return ""
+
+    def render_items(self, document: block_token.Document):
+        """
+        Yields (url, title, sections, meta) for each list item, rendering one top-level block at a time.
+        """
+        for token in document.children:
+            self.render(token)
+            yield from self.items
+            self.items = []
 
     def render_link(self, token: span_token.Link) -> str:
         if self.item.get('url', None) is None:
@@ -76,38 +85,35 @@ class JsonlRenderer(BaseRenderer):
         else:
             return ""
 
-@cache.memoize(expire=CACHE_FOR_SECONDS)
-def get_awesome_list(url):
-    log.warning(f"Fetching {url}")
-    r = requests.get(url)
-    if r.status_code != 200:
-        raise Exception("FAILED")
-    return r.text
+def get_awesome_list(url, cache_for: int = None):
+    return fetch_url(url, cache_for)
 
 def parse_input(input, source: Awesome, result: SourceResults):
-    with JsonlRenderer() as renderer:
-        jsonl: str = renderer.render(mistletoe.Document(input))
-        for json_item in jsonl.splitlines():
-            item = json.loads(json_item)
-            log.debug(f"Processing item {item}")
-            if item['url'] and not item['url'].startswith('#'): 
+    with RecordRenderer() as renderer:
+        for url, title, sections, meta in renderer.render_items(mistletoe.Document(input)):
+            log.debug(f"Processing item {title} {url}")
+            if url and not url.startswith('#'): 
                 # Set up as indexer record:
                 ir = IndexRecord(
                     source=source.name,
                     source_url=source.homepage,
-                    title=item['title'],
-                    url=item['url'],
-                    categories=item['sections'],
-                    metadata=item['meta'],
+                    title=title,
+                    url=url,
+                    categories=sections,
+                    metadata=meta,
                 )
                 # And return it
                 result.num_records += 1
                 yield ir
 
 def parse_awesome_list(source: Awesome, result: SourceResults):
-    text = get_awesome_list(source.url)
+    text = get_awesome_list(source.url, source.cache_for)
     yield from parse_input(text, source, result)
 
+# The list itself is small enough to act as its own version (and fetching it also warms the cache):
+def awesome_list_version(source: Awesome) -> str:
+    return get_awesome_list(source.url, source.cache_for)
+
 # For testing:
 if __name__ == "__main__":
     with open("test/awesome-web-archiving.md") as f:
@@ -0,0 +1,157 @@
+import time
+import random
+import logging
+import platform
+import tempfile
+from pathlib import Path
+from typing import Callable, List
+from .models import IndexRecord, SourceResults, Awesome, Zotero, Zenodo, Jsonl
+from .awelist import parse_input
+from .zotero import parse_zotero_items, get_collection_paths
+from .zenodo import parse_zenodo_hits
+from .pagefind import pagefind_record, PagefindSink
+from .exports import JsonlSink, SqliteSink, ParquetSink, write_records
+from .cli import generate_source_records
+from .stats import peak_rss_mb
+
+log = logging.getLogger(__name__)
+
+WORDS = (
+    "digital preservation archive format migration emulation fixity checksum metadata "
+    "repository storage web crawl capture replay access risk policy workflow software "
+    "collection record object file bitstream identifier registry audit trust community"
+).split()
+
+
+# Generators for synthetic sources of roughly the given number of records:
+def words(rng: random.Random, n: int) -> str:
+    return " ".join(rng.choices(WORDS, k=n))
+
+def generate_awesome_list(rng: random.Random, size: int) -> str:
+    lines = ["# Awesome Benchmark", ""]
+    for i in range(size):
+        if i % 50 == 0:
+            lines += ["", f"## {words(rng, 2).title()} {i}", ""]
+        if i % 10 == 0:
+            lines += ["", f"### {words(rng, 3).title()}", ""]
+        lines.append(f"- [{words(rng, 4).title()}](https://example.org/awesome/{i}) - {words(rng, 12)}.")
+    return "\n".join(lines) + "\n"
+
+def generate_zotero_library(rng: random.Random, size: int):
+    collections = []
+    for i in range(max(1, size // 100)):
+        parent = collections[rng.randrange(len(collections))]['key'] if collections and rng.random() < 0.7 else False
+        collections.append({ 'key': f"C{i:07d}", 'data': { 'name': words(rng, 2).title(), 'parentCollection': parent } })
+    items = []
+    for i in range(size):
+        item_type = 'attachment' if i % 10 == 9 else rng.choice(['journalArticle', 'book', 'report', 'webpage'])
+        items.append({ 'key': f"I{i:07d}", 'data': {
+            'itemType': item_type,
+            'title': words(rng, 6).title(),
+            'url': f"https://example.org/zotero/{i}",
+            'abstractNote': words(rng, 60),
+            'collections': [ c['key'] for c in rng.sample(collections, k=min(2, len(collections))) ],
+        }})
+    return items, collections
+
+def generate_zenodo_hits(rng: random.Random, size: int):
+    for i in range(size):
+        yield {
+            'id': i,
+            'doi_url': f"https://doi.org/10.5281/zenodo.{i}",
+            'metadata': {
+                'title': words(rng, 6).title(),
+                'description': words(rng, 80),
+                'keywords': rng.sample(WORDS, k=3),
+                'resource_type': { 'title': rng.choice(['Publication', 'Dataset', 'Software', 'Presentation']) },
+                'creators': [ { 'name': f"{words(rng, 1).title()}, {words(rng, 1).title()}" } for _ in range(rng.randint(1, 4)) ],
+                'publication_date': f"{rng.randint(1995, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            },
+        }
+
+def generate_jsonl(rng: random.Random, size: int, path: Path):
+    with open(path, "w") as f:
+        for i in range(size):
+            ir = IndexRecord(
+                title=words(rng, 6).title(),
+                url=f"https://example.org/jsonl/{i}",
+                creators=[ words(rng, 2).title() for _ in range(rng.randint(1, 5)) ],
+                abstract=words(rng, 100),
+                type=rng.choice(['paper', 'poster', 'panel']),
+                categories=[ words(rng, 2).title() ],
+                keywords=rng.sample(WORDS, k=4),
+                date=f"{rng.randint(2004, 2025)}-09-01T00:00:00",
+                metadata={ 'citation_conference_title': f"Conference {rng.randint(1, 20)}" },
+                source="jsonl",
+                source_url="https://example.org/",
+            )
+            f.write(ir.model_dump_json())
+            f.write("\n")
+
+
+# Run a stage, recording how long it took and how many records it handled:
+def run_stage(stages: List[dict], name: str, fn: Callable[[], int]):
+    log.info(f"Running benchmark stage {name}...")
+    start = time.perf_counter()
+    count = fn()
+    seconds = time.perf_counter() - start
+    stages.append({
+        'stage': name,
+        'records': count,
+        'seconds': round(seconds, 4),
+        'records_per_second': round(count / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+
+def parse_all(records: List[IndexRecord], source, parser) -> Callable[[], int]:
+    def fn():
+        result = SourceResults(name=source.name, homepage=source.homepage)
+        result.warnings = []
+        records.extend(parser(source, result))
+        return len(records)
+    return fn
+
+
+def run_benchmarks(size: int = 10000, seed: int = 42, pagefind: bool = False) -> dict:
+    rng = random.Random(seed)
+    stages = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path = Path(tmp)
+
+        # Parse each type of source:
+        text = generate_awesome_list(rng, size)
+        source = Awesome(name="Awesome", homepage="https://example.org/", type="awesome-list", url="https://example.org/README.md")
+        run_stage(stages, "parse:awesome-list", parse_all([], source, lambda s, r: parse_input(text, s, r)))
+
+        items, collections = generate_zotero_library(rng, size)
+        source = Zotero(name="Zotero", homepage="https://example.org/", type="zotero", library_id=1, library_type="group")
+        cols = { c['key']: c for c in collections }
+        run_stage(stages, "parse:zotero", parse_all([], source, lambda s, r: parse_zotero_items(s, r, items, collections, get_collection_paths(cols))))
+
+        hits = list(generate_zenodo_hits(rng, size))
+        source = Zenodo(name="Zenodo", homepage="https://example.org/", type="zenodo", community="benchmark")
+        run_stage(stages, "parse:zenodo", parse_all([], source, lambda s, r: parse_zenodo_hits(s, r, hits)))
+
+        jsonl_file = tmp_path / "records.jsonl"
+        generate_jsonl(rng, size, jsonl_file)
+        source = Jsonl(name="JSONL", homepage="https://example.org/", type="jsonl", file=str(jsonl_file))
+        records = []
+        run_stage(stages, "parse:jsonl", parse_all(records, source, generate_source_records))
+
+        # Then run the JSONL records through the conversions and exports:
+        run_stage(stages, "pagefind-records", lambda: sum(1 for ir in records if pagefind_record(ir)))
+        output_path = tmp_path / "output"
+        output_path.mkdir()
+        run_stage(stages, "export:jsonl", lambda: write_records(records, [JsonlSink(output_path)]))
+        run_stage(stages, "export:sqlite", lambda: write_records(records, [SqliteSink(output_path)]))
+        run_stage(stages, "export:parquet", lambda: write_records(records, [ParquetSink(output_path)]))
+        if pagefind:
+            run_stage(stages, "export:pagefind", lambda: write_records(records, [PagefindSink(output_path / "pagefind")]))
+
+    return {
+        'size': size,
+        'seed': seed,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'stages': stages,
+    }
@@ -0,0 +1,90 @@
+import zlib
+import pickle
+import logging
+from collections import Counter
+from typing import Optional
+from diskcache import Cache, Disk
+from diskcache.core import UNKNOWN
+from .models import CacheSettings
+
+log = logging.getLogger(__name__)
+
+# Markers for whether a stored value has been compressed or not:
+COMPRESSED = b"Z"
+UNCOMPRESSED = b"P"
+
+
+# Stores values as pickles, compressing the larger ones (e.g. API responses and Zotero mirrors):
+class CompressedDisk(Disk):
+    def __init__(self, directory, compress_threshold: int = 1024, compress_level: int = 6, **kwargs):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        super().__init__(directory, **kwargs)
+
+    def store(self, value, read, key=UNKNOWN):
+        if not read:
+            data = pickle.dumps(value, protocol=self.pickle_protocol)
+            if len(data) >= self.compress_threshold:
+                value = COMPRESSED + zlib.compress(data, self.compress_level)
+            else:
+                value = UNCOMPRESSED + data
+        return super().store(value, read, key=key)
+
+    def fetch(self, mode, filename, value, read):
+        data = super().fetch(mode, filename, value, read)
+        # Entries from caches written before compression was added are already unpickled:
+        if read or not isinstance(data, bytes):
+            return data
+        if data[:1] == COMPRESSED:
+            return pickle.loads(zlib.decompress(data[1:]))
+        return pickle.loads(data[1:])
+
+
+# The cache is set up from the config file at the start of a run, or with the defaults when first used:
+_cache: Optional[Cache] = None
+_settings = CacheSettings()
+
+def configure_cache(settings: CacheSettings):
+    global _cache, _settings
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+    _settings = settings
+
+def get_cache() -> Cache:
+    global _cache
+    if _cache is None:
+        _cache = Cache(
+            directory=_settings.directory,
+            disk=CompressedDisk,
+            disk_compress_threshold=_settings.compress_threshold,
+            size_limit=_settings.size_limit_mb * 1024 * 1024,
+            eviction_policy='least-recently-used',
+        )
+    return _cache
+
+# How long to keep entries, unless a source says otherwise:
+def cache_expiry(cache_for: Optional[int] = None) -> int:
+    return cache_for if cache_for is not None else _settings.expire
+
+
+# Summarise what's in the cache:
+def cache_stats() -> dict:
+    cache = get_cache()
+    kinds = Counter()
+    for key in cache.iterkeys():
+        kinds[key[0] if isinstance(key, tuple) else "other"] += 1
+    return {
+        'directory': cache.directory,
+        'entries': len(cache),
+        'size_mb': round(cache.volume() / (1024 * 1024), 2),
+        'size_limit_mb': _settings.size_limit_mb,
+        'entries_by_kind': dict(kinds),
+    }
+
+# Drop expired entries and, if needed, the least recently used ones until the cache is within its size limit:
+def prune_cache(everything: bool = False) -> int:
+    cache = get_cache()
+    if everything:
+        return cache.clear()
+    return cache.expire() + cache.cull()
@@ -1,63 +1,180 @@
 import os
+import sys
+import copy
+import hashlib
 import yaml
 import json
 import argparse
 import logging
-from typing import List
+import threading
+import queue
+import time
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from pydantic import ValidationError
-from sqlite_utils import Database
-import pyarrow as pa
-import pyarrow.parquet as pq
-from .awelist import parse_awesome_list
-from .zotero import parse_zotero
-from .zenodo import parse_zenodo
-from .models import Settings, IndexRecord, SourceResults
-from .pagefind import generate_pagefind_index
+from collections import Counter
+from .models import Settings, Record, SourceResults, SourceState, Manifest, BuildStats, SourceStats
+from .stats import source_stats, timed_stage, peak_rss_mb
+from .registry import source_function, sink_class
+# (The sources and exports are imported when they are needed, so e.g. checking a config stays quick)
 
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 log = logging.getLogger(__name__)
 
 
-def generate_index_records(config: Settings) -> List[SourceResults]:
-    results = []
-    for source in config.sources:
-        log.info(f"Indexing {source.name}...")
-        result = SourceResults(name=source.name, homepage=source.homepage, description=source.description)
-        result.records = []
-        if source.type == "awesome-list":
-            for ir in parse_awesome_list(source, result):
-                result.records.append(ir)
-        elif source.type == "zotero":
-            for ir in parse_zotero(source, result):
-                result.records.append(ir)
-        elif source.type == "zenodo":
-            for ir in parse_zenodo(source, result):
-                result.records.append(ir)
-        elif source.type == "jsonl":
-            with open(source.file) as f:
-                for line in f:
-                    ir = IndexRecord.model_validate_json(line)
-                    # Override the source field:
-                    ir.source = source.name
-                    ir.source_url = source.homepage
-                    result.records.append(ir)
-                    result.num_records += 1
-        else:
-            log.warning(f"No implementation for source type {source.type}! Skipping {source.name}.")
-        log.info(f"Gathered {len(result.records)} records from source {source.name}.")
-        results.append(result)
+# How many parsed records each source may hold while waiting to be exported:
+QUEUE_SIZE = 1000
+# Marks the end of a source's records on its queue:
+END_OF_SOURCE = object()
 
-    return results
+# The parsers validate each record, which is then kept in compact form for the rest of the build:
+def generate_source_records(source, result: SourceResults) -> Iterator[Record]:
+    log.info(f"Indexing {source.name}...")
+    parse = source_function(source.type, 'parse')
+    if parse is None:
+        log.warning(f"No implementation for source type {source.type}! Skipping {source.name}.")
+        return
+    for ir in parse(source, result):
+        yield ir if isinstance(ir, Record) else Record.from_index_record(ir)
+
+def put_record(records: queue.Queue, item, stop: threading.Event) -> bool:
+    # Block while the queue is full, unless the build has been abandoned:
+    while not stop.is_set():
+        try:
+            records.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def queue_source_records(source, result: SourceResults, records: queue.Queue, slot, stop: threading.Event, saved: Iterable[Record] = None):
+    # Wait for a free slot for this type of source, if there's a limit:
+    with slot, source_stats(result.stats) as stats:
+        # (Unless the build has failed meanwhile, so there's no point starting)
+        if stop.is_set():
+            return
+        start = time.perf_counter()
+        # (The fetches made while fingerprinting the source have already been counted)
+        fetched = stats.fetch_seconds
+        waiting = 0.0
+        try:
+            # Replay unchanged sources from the last build, or fetch and parse them:
+            for ir in saved if saved is not None else generate_source_records(source, result):
+                put_start = time.perf_counter()
+                if not put_record(records, ir, stop):
+                    return
+                waiting += time.perf_counter() - put_start
+        except Exception as e:
+            put_record(records, e, stop)
+            return
+        finally:
+            # Whatever wasn't spent fetching or waiting for the exports to catch up was spent parsing:
+            stats.fetch_seconds = round(stats.fetch_seconds, 4)
+            stats.parse_seconds = round(time.perf_counter() - start - waiting - (stats.fetch_seconds - fetched), 4)
+    put_record(records, END_OF_SOURCE, stop)
+
+def fingerprint_source(source, stats: SourceStats) -> Optional[str]:
+    from .manifest import source_fingerprint
+    with source_stats(stats):
+        return source_fingerprint(source)
+
+# Limits how many sources of a type are fetched at once, handing out the slots in config order.
+# The records are passed on in config order, so if a later source took the last slot while an earlier one waited for it,
+# it would fill its queue and wait forever for the earlier source to be passed on:
+class OrderedLimit:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.condition = threading.Condition()
+        self.running = 0
+        self.tickets = 0
+        self.next_ticket = 0
+
+    # Take a place in the queue for a slot (in config order), returning a context that holds the slot once it's our turn:
+    def slot(self):
+        with self.condition:
+            ticket = self.tickets
+            self.tickets += 1
+        return self.hold(ticket)
+
+    @contextmanager
+    def hold(self, ticket: int):
+        with self.condition:
+            self.condition.wait_for(lambda: self.next_ticket == ticket and self.running < self.limit)
+            self.next_ticket += 1
+            self.running += 1
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+# Per-source-type limits on how many can be fetched at once:
+def source_limits(config: Settings) -> Dict[str, OrderedLimit]:
+    limits = {}
+    for source_type, limit in (config.concurrency or {}).items():
+        limits[source_type] = OrderedLimit(limit)
+    return limits
 
-def collect_index_records(results: List[SourceResults]) -> List[IndexRecord]:
-    # Collect:
-    records = []
-    for source in results:
-        records += source.records
-    return records
+# The slot a source has to wait for, if its type is limited (taken in config order):
+def source_slot(limits: Dict[str, OrderedLimit], source):
+    return limits[source.type].slot() if source.type in limits else nullcontext()
 
-def add_templated_files(config, results, output_path, files):
+# Download a source into the cache, without parsing it:
+def warm_source(source, slot):
+    with slot:
+        log.info(f"Warming the cache for {source.name}...")
+        try:
+            # Check the version, as the build will, then fetch the rest:
+            for role in ['version', 'warm']:
+                if fetch := source_function(source.type, role):
+                    fetch(source)
+        except Exception as e:
+            log.warning(f"Could not warm the cache for {source.name}: {e}")
+
+def generate_index_records(config: Settings, results: List[SourceResults], replay: Dict[str, Tuple[SourceResults, Path]] = {}, stats: Dict[str, SourceStats] = {}, memory: Dict[str, List[Record]] = {}) -> Iterator[Record]:
+    from .manifest import read_source_part
+    limits = source_limits(config)
+    # Fetch and parse the sources in parallel, each into a bounded queue:
+    stop = threading.Event()
+    queues = []
+    with ThreadPoolExecutor(max_workers=max(1, config.workers)) as pool:
+        try:
+            for source in config.sources:
+                if source.name in replay:
+                    result, part = replay[source.name]
+                    # Copies of the records still held in memory are quicker to replay than the part file:
+                    saved = map(copy.copy, memory[source.name]) if source.name in memory else read_source_part(part)
+                else:
+                    result = SourceResults(name=source.name, homepage=source.homepage, description=source.description)
+                    result.warnings = []
+                    saved = None
+                result.stats = stats.get(source.name, None) or SourceStats()
+                result.stats.replayed = saved is not None
+                results.append(result)
+                records = queue.Queue(maxsize=QUEUE_SIZE)
+                queues.append(records)
+                pool.submit(queue_source_records, source, result, records, source_slot(limits, source), stop, saved)
+            # But pass the records on in config order:
+            for result, records in zip(results, queues):
+                count = 0
+                while (ir := records.get()) is not END_OF_SOURCE:
+                    if isinstance(ir, Exception):
+                        raise ir
+                    count += 1
+                    yield ir
+                log.info(f"Gathered {count} records from source {result.name}.")
+        finally:
+            # Release any workers still waiting on a full queue, and drop the sources that haven't started yet:
+            stop.set()
+            pool.shutdown(cancel_futures=True)
+
+def add_templated_files(config, results, output_path, files, shards=[], facets=None):
     from jinja2 import Environment, PackageLoader, select_autoescape
     env = Environment(
         loader=PackageLoader("awindex"),
@@ -66,7 +183,196 @@ def add_templated_files(config, results, output_path, files):
     for file in files:
         template = env.get_template(file)
         with open(output_path / file, "w") as fh:
-            fh.write(template.render(c=config, r=results))
+            fh.write(template.render(c=config, r=results, shards=shards, facets=facets))
+
+def load_config(config_file: str, output: str = None, workers: int = None) -> Settings:
+    with open(config_file, "r") as file:
+        config = Settings(**(yaml.safe_load(file) or {}))
+    # Add/override output path if specified:
+    if output:
+        config.output = output
+    if workers:
+        config.workers = workers
+    return config
+
+# Load the config, or explain what's wrong with it and stop:
+def load_config_or_exit(config_file: str, output: str = None, workers: int = None) -> Settings:
+    try:
+        return load_config(config_file, output, workers)
+    except OSError as e:
+        log.error(f"Could not read the configuration file {config_file}: {e}")
+    except (yaml.YAMLError, ValidationError) as e:
+        log.error(f"Invalid configuration file {config_file}: {e}")
+    sys.exit(1)
+
+# Build the index, reusing whatever hasn't changed since the last build.
+# When watching, the records of each source are also kept in memory, and the fingerprints of the sources are remembered
+# (so only sources known to have changed need checking again):
+def build_index(config: Settings, full: bool = False, jsonl: bool = False, memory: Dict[str, List[Record]] = None, known_fingerprints: Dict[str, str] = None) -> List[SourceResults]:
+    # Load what's needed to build the index:
+    from .cache import configure_cache
+    from .exports import DATASET_DIR, write_records
+    from .pagefind import list_shards
+    from .facets import FACETS_FILE, load_facets
+    from .manifest import BUILD_DIR, load_manifest, save_manifest, build_fingerprint, part_path, SourcePartsSink, SourceMemorySink
+    configure_cache(config.cache)
+
+    # Set up paths, including directory for the PageFind index:
+    output_path = Path(config.output)
+    index_path = output_path / "pagefind"
+    index_path.mkdir(parents=True, exist_ok=True)
+    build_stats = BuildStats(started=datetime.now())
+    build_start = time.perf_counter()
+    build_stats.sources = { source.name: SourceStats() for source in config.sources }
+
+    # Work out which sources have changed since the last build:
+    manifest = Manifest() if full else load_manifest(output_path)
+    known = known_fingerprints if known_fingerprints is not None else {}
+    unknown = [source for source in config.sources if source.name not in known]
+    with timed_stage(build_stats, "fingerprint"), ThreadPoolExecutor(max_workers=max(1, config.workers)) as pool:
+        checked = dict(zip(
+            [source.name for source in unknown],
+            pool.map(fingerprint_source, unknown, [build_stats.sources[source.name] for source in unknown])
+        ))
+    fingerprints = { source.name: known.get(source.name, None) or checked[source.name] for source in config.sources }
+    known.update({ name: fp for name, fp in checked.items() if fp })
+    build = build_fingerprint(fingerprints)
+    # The optional stages that change the records, so saved records can only be replayed if they went through the same ones:
+    stages = []
+    if config.check_links:
+        stages.append("links-checked")
+    if config.full_text:
+        # (Along with the settings that change the text, so changing them means harvesting it again)
+        harvest = config.full_text.model_dump_json(include={'max_bytes', 'max_chars', 'mirrors', 'sources'})
+        stages.append(f"full-text:{hashlib.sha256(harvest.encode()).hexdigest()[:12]}")
+    held = memory or {}
+    replay = {}
+    for name, fp in fingerprints.items():
+        previous = manifest.sources.get(name, None)
+        part = part_path(output_path, name)
+        if fp and previous and previous.fingerprint == fp and (name in held or part.exists() or previous.summary.num_records == 0) \
+            and previous.stages == stages:
+            replay[name] = (previous.summary, part)
+    changed = set(fingerprints) - set(replay)
+    removed = set(manifest.sources) - set(fingerprints)
+    # What each output should have been built from (including any options that change it):
+    staged = "".join(f" {stage}" for stage in stages)
+    options = f"{staged} deduplicated" if config.deduplicate else staged
+    artifacts = {
+        "records.db": f"{build}{options}",
+        FACETS_FILE: f"{build}{options}",
+        "records.parquet": f"{build}{options} {config.parquet.model_dump_json()}",
+        "pagefind": f"{build}{options} shards={config.pagefind_shards}",
+    }
+    if jsonl:
+        artifacts["records.jsonl"] = f"{build}{options}"
+    if config.parquet.partitioned:
+        artifacts[DATASET_DIR] = f"{build}{options} {config.parquet.model_dump_json()}"
+
+    # Link checks go out of date, and then have to be done again even if no source has changed:
+    links_stale = config.check_links is not None and manifest.links_valid_until is not None and manifest.links_valid_until <= datetime.now()
+    if links_stale:
+        log.info("Some of the link checks are out of date, so the links will be checked again.")
+
+    if build and not links_stale and all(manifest.artifacts.get(a, None) == fp and (output_path / a).exists() for a, fp in artifacts.items()):
+        log.info("No sources have changed since the last build, so skipping the exports.")
+        results = [replay[source.name][0] for source in config.sources]
+        build_stats.records = sum(result.num_records for result in results)
+        for result in results:
+            result.stats = build_stats.sources[result.name]
+    else:
+        log.info(f"Rebuilding {len(changed)} changed source(s) and reusing {len(replay)} unchanged source(s).")
+        # The SQLite DB can be patched if it is known to match the last build, and records haven't been merged across sources
+        # (nor had their links checked again, which can change the records of any source):
+        patch_db = not links_stale and manifest.build is not None and manifest.artifacts.get("records.db", None) == f"{manifest.build}{staged}" \
+            and (output_path / "records.db").exists() and not config.deduplicate
+        # Likewise the partitions of the Parquet dataset, as long as it was written with the same settings:
+        patch_dataset = not links_stale and manifest.build is not None \
+            and manifest.artifacts.get(DATASET_DIR, None) == f"{manifest.build}{staged} {config.parquet.model_dump_json()}" \
+            and (output_path / DATASET_DIR).exists() and not config.deduplicate
+        # Record that a build is underway, so if it fails the next one starts afresh:
+        save_manifest(output_path, Manifest(sources={name: manifest.sources[name] for name in replay}))
+        for name in removed:
+            part_path(output_path, name).unlink(missing_ok=True)
+
+        # Stream the source records through each of the exports:
+        results = []
+        exports = []
+        # Generate raw JSONL output
+        if jsonl:
+            exports.append(partial(sink_class('jsonl'), output_path))
+        # Generate SQLite DB and Parquet exports:
+        exports.append(partial(sink_class('sqlite'), output_path, replace=(changed | removed) if patch_db else None))
+        exports.append(partial(sink_class('parquet'), output_path, config.parquet))
+        if config.parquet.partitioned:
+            exports.append(partial(sink_class('parquet-dataset'), output_path, config.parquet, replace=(changed | removed) if patch_dataset else None))
+        # Generate the PageFind index file:
+        exports.append(partial(sink_class('pagefind'), index_path, shard_by=config.pagefind_shards))
+        # The exports are independent, so can run side by side if there are the CPUs for it:
+        processes = config.export_processes or min(len(exports), os.cpu_count() or 1)
+        if processes > 1:
+            from .scheduler import ParallelSinks
+            sinks = [ParallelSinks(exports, output_path / BUILD_DIR / "export-buffer.pickle", processes, build_stats)]
+        else:
+            sinks = [make_sink() for make_sink in exports]
+        # Count up the facets, once the SQLite DB is ready to hold them:
+        sinks.append(sink_class('facets')(output_path))
+        # The part files keep each source's own records, so duplicates are merged after they are saved:
+        if config.deduplicate:
+            from .dedup import DeduplicatingSink
+            sinks = [DeduplicatingSink(sinks, build_stats)]
+        sinks.insert(0, SourcePartsSink(output_path, changed))
+        kept = {}
+        if memory is not None:
+            sinks.insert(0, SourceMemorySink(kept))
+        records = generate_index_records(config, results, replay, build_stats.sources, held)
+        checker = None
+        if config.check_links:
+            from .links import LinkChecker, check_links
+            checker = LinkChecker(config.check_links)
+            records = check_links(records, checker)
+        if config.full_text:
+            from .fulltext import harvest_full_text
+            records = harvest_full_text(records, config.full_text)
+        with timed_stage(build_stats, "export") as stage:
+            stage.records = write_records(records, sinks, build_stats)
+        build_stats.records = stage.records
+
+        # Record what went into this build:
+        save_manifest(output_path, Manifest(
+            build=build,
+            sources={
+                result.name: SourceState(fingerprint=fingerprints[result.name], summary=result, stages=stages)
+                for result in results
+            },
+            artifacts=artifacts if build else {},
+            links_valid_until=datetime.fromtimestamp(checker.valid_until) if checker and checker.valid_until else None,
+        ))
+        # Only hold on to the records once they are known to match the manifest:
+        if memory is not None:
+            memory.clear()
+            memory.update(kept)
+
+    # Put templated index file in place, now the source totals are known:
+    with timed_stage(build_stats, "templates"):
+        add_templated_files(config, results, output_path, ["index.html", "styles.css"], list_shards(output_path), load_facets(output_path))
+
+    # Output stats summary of the sources:
+    log.info("Generating JSONL summary...")
+    with timed_stage(build_stats, "summary"), open( output_path / "summary.jsonl", "w" ) as f:
+        for result in results:
+            f.write(result.model_dump_json(exclude={'records'}))
+            f.write("\n")
+
+    # And record how the build went:
+    build_stats.seconds = round(time.perf_counter() - build_start, 4)
+    build_stats.peak_rss_mb = peak_rss_mb()
+    for stats in build_stats.sources.values():
+        stats.fetch_seconds = round(stats.fetch_seconds, 4)
+    with open( output_path / "build-stats.json", "w" ) as f:
+        f.write(build_stats.model_dump_json(indent=2))
+    log.info(f"Build took {build_stats.seconds} seconds, see build-stats.json for details.")
+    return results
 
 def main():
     # Parse arguments
@@ -83,63 +389,90 @@ def main():
         help="Path to the output directory for HTML files. Overrides the value in the config file."
     )
     parser.add_argument('--jsonl', action=argparse.BooleanOptionalAction)
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        help="Number of sources to fetch and parse at the same time. Overrides the value in the config file."
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help="Rebuild every source and output from scratch, ignoring the results of the last build."
+    )
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help="Check the configuration file is valid, without fetching any sources or building the index."
+    )
+    subparsers = parser.add_subparsers(dest='command', title="commands", description="Run without a command to build the index.")
+    bench_parser = subparsers.add_parser('bench', help="Benchmark the parsers and exports against synthetic sources.")
+    bench_parser.add_argument(
+        '-n', '--size',
+        type=int,
+        default=10000,
+        help="Number of records to generate for each type of source."
+    )
+    bench_parser.add_argument('--seed', type=int, default=42, help="Seed for the synthetic data generator.")
+    bench_parser.add_argument('--pagefind', action='store_true', help="Include the (slow) PageFind indexing stage.")
+    bench_parser.add_argument('--stats', type=str, help="Path to write the JSON results to, instead of printing them.")
+    cache_parser = subparsers.add_parser('cache', help="Inspect or manage the download cache.")
+    cache_parser.add_argument(
+        'action',
+        choices=['stats', 'prune', 'warm'],
+        help="Summarise the cache, drop expired entries and any beyond the size limit, or download the sources ahead of a build."
+    )
+    cache_parser.add_argument('--all', action='store_true', help="When pruning, empty the cache completely.")
+    watch_parser = subparsers.add_parser('watch', help="Build the index, then serve it and rebuild whatever is affected when the config or a local source changes.")
+    watch_parser.add_argument('--port', type=int, default=8000, help="Port to serve the index on locally (0 to not serve it).")
+    watch_parser.add_argument('--interval', type=float, default=1.0, help="How often to check for changes, in seconds.")
     args = parser.parse_args()
 
+    if args.command == 'bench':
+        from .bench import run_benchmarks
+        stats = run_benchmarks(size=args.size, seed=args.seed, pagefind=args.pagefind)
+        if args.stats:
+            with open(args.stats, "w") as f:
+                json.dump(stats, f, indent=2)
+        else:
+            print(json.dumps(stats, indent=2))
+        return
+
+    if args.command == 'cache':
+        from .cache import configure_cache, cache_stats, prune_cache
+        # Use the cache settings from the config file, if there is one:
+        config = None
+        if os.path.exists(args.config):
+            config = load_config_or_exit(args.config)
+            configure_cache(config.cache)
+        if args.action == 'stats':
+            print(json.dumps(cache_stats(), indent=2))
+        elif args.action == 'prune':
+            log.info(f"Removed {prune_cache(everything=args.all)} entries from the cache.")
+        elif args.action == 'warm':
+            if config is None:
+                parser.error(f"Warming the cache needs the config file, but {args.config} could not be found.")
+            limits = source_limits(config)
+            with ThreadPoolExecutor(max_workers=max(1, config.workers)) as pool:
+                slots = [source_slot(limits, source) for source in config.sources]
+                list(pool.map(warm_source, config.sources, slots))
+            print(json.dumps(cache_stats(), indent=2))
+        return
+
     # Run with the config:
     config_file = args.config
-    with open(config_file, "r") as file:
-        try:
-            config = Settings(**yaml.safe_load(file))
-            # Add/override output path if specified:
-            if args.output:
-                config.output = args.output
-
-            # Collect the source records
-            log.info(f"Reading config in {config_file}, generating output here: {config.output}")
-            results = generate_index_records(config)
-            records = collect_index_records(results)
-
-            # Set up paths, including directory for the PageFind index:
-            output_path = Path(config.output)
-            index_path = output_path / "pagefind"
-            index_path.mkdir(parents=True, exist_ok=True)
-
-            # Put templated index file in place:
-            add_templated_files(config, results, output_path, ["index.html", "styles.css"])
-
-            # Output stats summary of the sources:
-            log.info("Generating JSONL summary...")
-            with open( output_path / "summary.jsonl", "w" ) as f:
-                for result in results:
-                    f.write(result.model_dump_json(exclude={'records'}))
-                    f.write("\n")
-
-            # Generate raw JSONL output
-            if args.jsonl:
-                log.info("Generating JSONL export...")
-                with open( output_path / "records.jsonl", "w") as f:
-                    for ir in records:
-                        f.write(ir.model_dump_json())
-                        f.write("\n")
-
-            # Generate SQLite DB
-            log.info("Generating SQLite export...")
-            sql_path = output_path / "records.db"
-            db = Database(sql_path, recreate=True)
-            for ir in records:
-                db["index"].insert(ir.model_dump())
-            db["index"].enable_fts(['title', 'abstract', 'full_text', 'creators', 'keywords', 'categories'])
-
-            log.info("Generating Parquet export...")
-            plain_records = [item.model_dump() for item in records]
-            table = pa.Table.from_pylist(plain_records)
-            pq.write_table(table,  output_path / "records.parquet" )
-
-            # Generate the PageFind index file:
-            generate_pagefind_index(index_path, records)
-
-        except ValidationError as e:
-            log.exception("Invalid configuration file", e)
+    config = load_config_or_exit(config_file, args.output, args.workers)
+    if args.check:
+        types = Counter(source.type for source in config.sources)
+        summary = ", ".join(f"{count} {source_type}" for source_type, count in types.items())
+        log.info(f"The configuration in {config_file} is valid, with {len(config.sources)} sources ({summary}).")
+        return
+
+    log.info(f"Reading config in {config_file}, generating output here: {config.output}")
+    if args.command == 'watch':
+        from .watch import watch
+        watch(config_file, config, port=args.port, interval=args.interval, full=args.full, jsonl=args.jsonl, output=args.output, workers=args.workers)
+    else:
+        build_index(config, full=args.full, jsonl=args.jsonl)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import re
+import logging
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit, parse_qsl, urlencode, unquote
+from .models import Record, BuildStats
+from .exports import Sink, write_records, abort_sinks
+
+log = logging.getLogger(__name__)
+
+# Spot DOIs, whether as doi.org URLs or doi: URIs:
+RE_DOI = re.compile(r"^(?:https?://(?:dx\.)?doi\.org/|doi:)(10\.\d{4,9}/\S+)$", re.IGNORECASE)
+# Tracking parameters that don't change what a URL points to:
+IGNORED_PARAMS = ('utm_', 'fbclid', 'gclid')
+
+
+# Normalise the URL of a record, so the same resource found in different sources has the same key.
+# Records with no DOI or host (e.g. an empty or relative URL) can't be matched up, so have no key:
+def record_key(ir: Record) -> Optional[str]:
+    url = ir.url.strip()
+    if m := RE_DOI.match(url):
+        return f"doi:{unquote(m.group(1)).lower()}"
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if not host:
+        return None
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip("/")
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith(IGNORED_PARAMS)
+    ))
+    # Ignore the scheme and fragment, as http/https and anchors still point at the same thing:
+    return f"{host}{path}?{query}" if query else f"{host}{path}"
+
+def union(a: Optional[List[str]], b: Optional[List[str]]) -> Optional[List[str]]:
+    if not b:
+        return a
+    if not a:
+        return b
+    return a + [v for v in b if v not in a]
+
+def longest(a: Optional[str], b: Optional[str]) -> Optional[str]:
+    return b if len(b or "") > len(a or "") else a
+
+# Fold a duplicate into a record, keeping the richest version of each field:
+def merge_records(ir: Record, dup: Record):
+    ir.sources = union(ir.sources or [ir.source], dup.sources or [dup.source])
+    ir.categories = union(ir.categories, dup.categories)
+    ir.keywords = union(ir.keywords, dup.keywords)
+    ir.abstract = longest(ir.abstract, dup.abstract)
+    ir.full_text = longest(ir.full_text, dup.full_text)
+    if len(dup.creators or []) > len(ir.creators or []):
+        ir.creators = dup.creators
+    for field in ['type', 'license', 'date', 'weight']:
+        if getattr(ir, field) is None:
+            setattr(ir, field, getattr(dup, field))
+    if dup.metadata:
+        ir.metadata = { **dup.metadata, **(ir.metadata or {}) }
+    if dup.links:
+        ir.links = { **dup.links, **(ir.links or {}) }
+
+
+# Sink that merges records with the same URL or DOI, then passes them on to the other sinks once all are in:
+class DeduplicatingSink(Sink):
+    name = "deduplication"
+
+    def __init__(self, sinks: List[Sink], stats: BuildStats = None):
+        self.sinks = sinks
+        self.stats = stats
+        self.records: Dict[Union[str, Tuple[str, int]], Record] = {}
+        self.duplicates = 0
+        self.unkeyed = 0
+
+    def add(self, ir: Record):
+        key = record_key(ir)
+        # Records without a key are passed on as they are, in their place:
+        if key is None:
+            key = ("unkeyed", self.unkeyed)
+            self.unkeyed += 1
+        if key in self.records:
+            merge_records(self.records[key], ir)
+            self.duplicates += 1
+        else:
+            self.records[key] = ir
+
+    def close(self):
+        log.info(f"Merged {self.duplicates} duplicate records, leaving {len(self.records)} unique records.")
+        write_records(self.records.values(), self.sinks, self.stats)
+
+    def abort(self):
+        abort_sinks(self.sinks)
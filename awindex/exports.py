@@ -0,0 +1,364 @@
+import os
+import json
+import time
+import shutil
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Union, get_args, get_origin
+from urllib.parse import quote, unquote
+from sqlite_utils import Database
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .models import IndexRecord, Record, BuildStats, StageStats, ParquetSettings
+from .stats import peak_rss_mb
+
+log = logging.getLogger(__name__)
+
+# How many records to buffer before writing a block of rows out:
+BATCH_SIZE = 10000
+
+# Arrow types for the IndexRecord field types:
+def arrow_type(annotation):
+    # Unwrap Optional[...]:
+    args = [a for a in get_args(annotation) if a is not type(None)]
+    if get_origin(annotation) is Union:
+        return arrow_type(args[0])
+    if get_origin(annotation) is list:
+        return pa.list_(arrow_type(args[0]))
+    if get_origin(annotation) is dict:
+        return pa.map_(arrow_type(args[0]), arrow_type(args[1]))
+    # Dates are stored as UTC, so ones with a timezone keep the right instant (and ones without are taken as UTC):
+    return { str: pa.string(), int: pa.int64(), datetime: pa.timestamp('us', tz='UTC') }[annotation]
+
+# Fixed Arrow schema for the IndexRecord fields, so every batch is written the same way:
+RECORD_SCHEMA = pa.schema([
+    (name, arrow_type(field.annotation)) for name, field in IndexRecord.model_fields.items()
+])
+
+
+# A sink receives each record once, as it flows through the build:
+class Sink:
+    name = "sink"
+
+    def add(self, ir: Record):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    # Called instead of close if the build fails, to clean up without replacing the output of the last build:
+    def abort(self):
+        pass
+
+
+# Outputs are written under a temporary name, and only replace the previous ones once they are complete:
+def partial_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.partial")
+
+
+# Raw JSONL output:
+class JsonlSink(Sink):
+    name = "JSONL"
+
+    def __init__(self, output_path: Path):
+        self.path = output_path / "records.jsonl"
+        self.fh = open(partial_path(self.path), "w")
+
+    def add(self, ir: Record):
+        self.fh.write(ir.to_index_record().model_dump_json())
+        self.fh.write("\n")
+
+    def close(self):
+        self.fh.close()
+        os.replace(partial_path(self.path), self.path)
+
+    def abort(self):
+        self.fh.close()
+        partial_path(self.path).unlink(missing_ok=True)
+
+
+# SQLite column types for the IndexRecord fields (lists and dicts are stored as JSON text):
+SQLITE_COLUMNS = {
+    name: int if field.annotation in (int, Optional[int]) else str
+    for name, field in IndexRecord.model_fields.items()
+}
+
+def sqlite_value(v):
+    if isinstance(v, (list, dict)):
+        return json.dumps(v)
+    if isinstance(v, datetime):
+        return v.isoformat()
+    return v
+
+
+# SQLite DB, with full-text search:
+class SqliteSink(Sink):
+    name = "SQLite"
+
+    def __init__(self, output_path: Path, replace: Optional[Set[str]] = None):
+        """
+        Args:
+            replace (set): If set, patch the existing DB by replacing only the records from these sources.
+        """
+        self.replace = replace
+        self.path = output_path / "records.db"
+        # A new DB is built alongside the old one, but a patched one is changed in place:
+        self.db = Database(partial_path(self.path) if replace is None else self.path, recreate=replace is None)
+        # A new DB can just be regenerated if anything goes wrong, so skip the safety nets:
+        if replace is None:
+            self.db.execute("PRAGMA page_size = 8192")
+            self.db.execute("PRAGMA journal_mode = OFF")
+        else:
+            # But a patch has to be possible to roll back:
+            self.db.execute("PRAGMA journal_mode = MEMORY")
+        self.db.execute("PRAGMA synchronous = OFF")
+        # Declare the schema up front rather than inspecting each row:
+        if replace is None:
+            self.db["index"].create(SQLITE_COLUMNS)
+        columns = ", ".join(f"[{name}]" for name in SQLITE_COLUMNS)
+        values = ", ".join("?" for _ in SQLITE_COLUMNS)
+        self.insert_sql = f"INSERT INTO [index] ({columns}) VALUES ({values})"
+        self.batch = []
+        # Add all the records in a single transaction:
+        self.db.conn.execute("BEGIN")
+        if replace:
+            self.db.conn.executemany("DELETE FROM [index] WHERE source = ?", [(name,) for name in replace])
+
+    def add(self, ir: Record):
+        # When patching, records from the other sources are already in place:
+        if self.replace is not None and ir.source not in self.replace:
+            return
+        self.batch.append(tuple(sqlite_value(getattr(ir, name)) for name in SQLITE_COLUMNS))
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.db.conn.executemany(self.insert_sql, self.batch)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.db.conn.commit()
+        # Build the full-text index in one pass, now all the records are in:
+        if self.replace is None:
+            self.db["index"].enable_fts(['title', 'abstract', 'full_text', 'creators', 'keywords', 'categories'])
+        else:
+            self.db["index"].rebuild_fts()
+        self.db.close()
+        if self.replace is None:
+            os.replace(partial_path(self.path), self.path)
+
+    def abort(self):
+        if self.replace is not None:
+            self.db.conn.rollback()
+        self.db.close()
+        if self.replace is None:
+            partial_path(self.path).unlink(missing_ok=True)
+
+
+# Parquet, written out one row group at a time:
+class ParquetSink(Sink):
+    name = "Parquet"
+    # Columns with few distinct values, that compress well as dictionaries:
+    dictionary_columns = ['type', 'language', 'source', 'source_url', 'license']
+
+    def __init__(self, output_path: Path, settings: ParquetSettings = None):
+        self.settings = settings or ParquetSettings()
+        self.path = output_path / "records.parquet"
+        self.writer = pq.ParquetWriter(
+            partial_path(self.path),
+            RECORD_SCHEMA,
+            compression=self.settings.compression,
+            compression_level=self.settings.compression_level,
+            use_dictionary=self.dictionary_columns,
+        )
+        self.batch = []
+
+    def add(self, ir: Record):
+        self.batch.append(ir.to_dict())
+        if len(self.batch) >= self.settings.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            table = pa.Table.from_pylist(self.batch, schema=RECORD_SCHEMA)
+            self.writer.write_table(table, row_group_size=self.settings.row_group_size)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(partial_path(self.path), self.path)
+
+    def abort(self):
+        self.writer.close()
+        partial_path(self.path).unlink(missing_ok=True)
+
+
+# Hive-style partitioned Parquet dataset, so queries on a source or year only read the files they need:
+DATASET_DIR = "records-dataset"
+# The value used by Arrow and Hive for partitions with no value (i.e. records with no date):
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+# The source is given by the partition path, so isn't repeated in the files:
+DATASET_SCHEMA = RECORD_SCHEMA.remove(RECORD_SCHEMA.get_field_index("source"))
+
+# The year of a date as stored in the Parquet files, i.e. in UTC:
+def utc_year(date: datetime) -> int:
+    return date.astimezone(timezone.utc).year if date.tzinfo else date.year
+
+def source_partition(name: str) -> str:
+    return f"source={quote(name, safe='')}"
+
+class PartitionedParquetSink(Sink):
+    name = "partitioned Parquet"
+
+    def __init__(self, output_path: Path, settings: ParquetSettings = None, replace: Optional[Set[str]] = None):
+        """
+        Args:
+            replace (set): If set, patch the existing dataset by rewriting only the partitions of these sources.
+        """
+        self.settings = settings or ParquetSettings()
+        self.replace = replace
+        self.dataset_path = output_path / DATASET_DIR
+        # The new partitions are written to one side, and only moved into the dataset once they are complete:
+        self.staging_path = partial_path(self.dataset_path)
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+        self.staging_path.mkdir(parents=True)
+        # Sources arrive one after another, so only the current source's partitions are open at any one time:
+        self.source = None
+        self.writers: Dict[str, pq.ParquetWriter] = {}
+        self.batches: Dict[str, List[dict]] = {}
+        self.parts = Counter()
+
+    def add(self, ir: Record):
+        # When patching, the partitions of the other sources are already in place:
+        if self.replace is not None and ir.source not in self.replace:
+            return
+        if ir.source != self.source:
+            self.close_source()
+            self.source = ir.source
+        year = str(utc_year(ir.date)) if ir.date else NULL_PARTITION
+        batch = self.batches.setdefault(year, [])
+        fields = ir.to_dict()
+        del fields['source']
+        batch.append(fields)
+        if len(batch) >= self.settings.row_group_size:
+            self.flush(year)
+
+    def flush(self, year: str):
+        if not self.batches.get(year):
+            return
+        if year not in self.writers:
+            path = self.staging_path / source_partition(self.source) / f"year={year}"
+            path.mkdir(parents=True, exist_ok=True)
+            # Number the files, in case a source turns up again later on:
+            part = self.parts[(self.source, year)]
+            self.parts[(self.source, year)] += 1
+            self.writers[year] = pq.ParquetWriter(
+                path / f"part-{part}.parquet",
+                DATASET_SCHEMA,
+                compression=self.settings.compression,
+                compression_level=self.settings.compression_level,
+                use_dictionary=[c for c in ParquetSink.dictionary_columns if c != 'source'],
+            )
+        table = pa.Table.from_pylist(self.batches[year], schema=DATASET_SCHEMA)
+        self.writers[year].write_table(table, row_group_size=self.settings.row_group_size)
+        self.batches[year] = []
+
+    def close_source(self):
+        for year in list(self.batches):
+            self.flush(year)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        self.batches = {}
+
+    def close(self):
+        self.close_source()
+        if self.replace is None:
+            shutil.rmtree(self.dataset_path, ignore_errors=True)
+            self.staging_path.rename(self.dataset_path)
+        else:
+            for name in self.replace:
+                shutil.rmtree(self.dataset_path / source_partition(name), ignore_errors=True)
+                if (staged := self.staging_path / source_partition(name)).exists():
+                    staged.rename(self.dataset_path / source_partition(name))
+            shutil.rmtree(self.staging_path)
+        write_dataset_summary(self.dataset_path)
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+
+# Summarise the partitions from the Parquet file footers, so tools can plan queries without opening every file:
+def write_dataset_summary(dataset_path: Path):
+    partitions = []
+    for path in sorted(dataset_path.glob("source=*/year=*/*.parquet")):
+        metadata = pq.read_metadata(path)
+        date_column = metadata.schema.to_arrow_schema().get_field_index("date")
+        dates = [
+            metadata.row_group(i).column(date_column).statistics
+            for i in range(metadata.num_row_groups)
+        ]
+        dates = [s for s in dates if s is not None and s.has_min_max]
+        year = path.parent.name.split("=", 1)[1]
+        partitions.append({
+            'path': path.relative_to(dataset_path).as_posix(),
+            'source': unquote(path.parent.parent.name.split("=", 1)[1]),
+            'year': None if year == NULL_PARTITION else int(year),
+            'records': metadata.num_rows,
+            'bytes': path.stat().st_size,
+            'min_date': min(s.min for s in dates).isoformat() if dates else None,
+            'max_date': max(s.max for s in dates).isoformat() if dates else None,
+        })
+    summary = {
+        'partitioning': ['source', 'year'],
+        'records': sum(p['records'] for p in partitions),
+        'schema': [ { 'name': f.name, 'type': str(f.type) } for f in DATASET_SCHEMA ],
+        'partitions': partitions,
+    }
+    with open(dataset_path / "_dataset.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+
+# Clean up after a failed build, without letting any further problems hide the original one:
+def abort_sinks(sinks: List[Sink]):
+    for sink in sinks:
+        try:
+            sink.abort()
+        except Exception as e:
+            log.warning(f"Could not clean up the {sink.name} export: {e}")
+
+# Pass each record through all the sinks, then close them all (or abort them, if anything goes wrong):
+def write_records(records: Iterable[Record], sinks: List[Sink], stats: BuildStats = None) -> int:
+    count = 0
+    seconds = [0.0] * len(sinks)
+    try:
+        for ir in records:
+            for i, sink in enumerate(sinks):
+                start = time.perf_counter()
+                sink.add(ir)
+                seconds[i] += time.perf_counter() - start
+            count += 1
+    except BaseException:
+        log.error(f"The build failed after {count} records, so the exports have been abandoned.")
+        abort_sinks(sinks)
+        raise
+    for i, sink in enumerate(sinks):
+        log.info(f"Finishing {sink.name} export...")
+        start = time.perf_counter()
+        try:
+            sink.close()
+        except BaseException:
+            abort_sinks(sinks[i+1:])
+            raise
+        seconds[i] += time.perf_counter() - start
+        if stats:
+            stats.stages.append(StageStats(name=f"export:{sink.name}", seconds=round(seconds[i], 4), records=count, peak_rss_mb=peak_rss_mb()))
+    log.info(f"Exported {count} records.")
+    return count
@@ -0,0 +1,73 @@
+import json
+import logging
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional
+from sqlite_utils import Database
+from .models import Record
+from .exports import Sink
+
+log = logging.getLogger(__name__)
+
+# The facets to count, named after the matching PageFind filters:
+FACETS = ['source', 'type', 'year', 'categories', 'keywords', 'creators']
+FACETS_FILE = "facets.json"
+# Keep the JSON small by only listing the most common values of each facet:
+MAX_FACET_VALUES = 100
+
+
+def facet_values(ir: Record, facet: str) -> List[str]:
+    if facet == 'source':
+        return ir.sources or [ir.source]
+    if facet == 'type':
+        return [ir.type] if ir.type else []
+    if facet == 'year':
+        return [str(ir.date.year)] if ir.date else []
+    return getattr(ir, facet) or []
+
+
+# Sink that counts the records for each value of each facet, so they can be shown without running a search:
+class FacetsSink(Sink):
+    name = "facets"
+
+    def __init__(self, output_path: Path):
+        self.output_path = output_path
+        self.counts = { facet: Counter() for facet in FACETS }
+        self.records = 0
+
+    def add(self, ir: Record):
+        self.records += 1
+        for facet, counter in self.counts.items():
+            counter.update(facet_values(ir, facet))
+
+    def close(self):
+        facets = {
+            'records': self.records,
+            'facets': {
+                facet: {
+                    'distinct': len(counter),
+                    'values': counter.most_common(MAX_FACET_VALUES),
+                }
+                for facet, counter in self.counts.items()
+            },
+        }
+        with open(self.output_path / FACETS_FILE, "w") as f:
+            json.dump(facets, f, separators=(',', ':'))
+        # And all the counts go in the database, which is written before this sink is closed:
+        db_path = self.output_path / "records.db"
+        if db_path.exists():
+            db = Database(db_path)
+            db["facets"].drop(ignore=True)
+            db["facets"].insert_all((
+                { 'facet': facet, 'value': value, 'count': count }
+                for facet, counter in self.counts.items()
+                for value, count in counter.most_common()
+            ), pk=('facet', 'value'))
+            db.close()
+
+def load_facets(output_path: Path) -> Optional[dict]:
+    facets_file = output_path / FACETS_FILE
+    if facets_file.exists():
+        with open(facets_file) as f:
+            return json.load(f)
+    return None
@@ -0,0 +1,226 @@
+import io
+import re
+import time
+import logging
+import threading
+import multiprocessing
+from collections import Counter
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Iterator, Optional
+from urllib.parse import urlsplit, unquote
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from requests import Session
+from requests.adapters import HTTPAdapter
+from .models import Record, FullTextSettings
+from .cache import get_cache
+from .utils import lookahead
+
+log = logging.getLogger(__name__)
+
+# Elements that don't hold any of the actual text of a page:
+SKIP_ELEMENTS = {'head', 'script', 'style', 'noscript', 'template', 'svg', 'nav', 'header', 'footer', 'form'}
+RE_SPACES = re.compile(r"\s+")
+# Only report this many of the failures in full:
+MAX_WARNINGS = 20
+
+
+class TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.skipping = 0
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_ELEMENTS:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_ELEMENTS and self.skipping > 0:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.text.append(data)
+
+def extract_html(data: bytes, charset: str) -> str:
+    parser = TextExtractor()
+    parser.feed(data.decode(charset or "utf-8", errors="replace"))
+    parser.close()
+    return " ".join(parser.text)
+
+def extract_pdf(data: bytes) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise Exception("Extracting text from PDFs requires the pypdf package, e.g. pip install awindex[pdf]")
+    reader = PdfReader(io.BytesIO(data))
+    return " ".join(page.extract_text() or "" for page in reader.pages)
+
+# Collapse the whitespace, and cut the text down to size at a word boundary:
+def normalise_text(text: str, max_chars: int) -> str:
+    text = RE_SPACES.sub(" ", text).strip()
+    if len(text) > max_chars:
+        text = text[:max_chars].rsplit(" ", 1)[0]
+    return text
+
+# Get the text from a downloaded resource (in a worker process):
+def extract_text(data: bytes, content_type: str, max_chars: int) -> Optional[str]:
+    mime, _, params = content_type.lower().partition(";")
+    mime = mime.strip()
+    if mime == "application/pdf" or data.startswith(b"%PDF-"):
+        text = extract_pdf(data)
+    elif mime in ("text/html", "application/xhtml+xml"):
+        charset = params.partition("charset=")[2].strip().strip('"') or None
+        text = extract_html(data, charset)
+    elif mime.startswith("text/"):
+        text = data.decode("utf-8", errors="replace")
+    else:
+        return None
+    return normalise_text(text, max_chars) or None
+
+def guess_content_type(path: Path) -> str:
+    return {
+        '.pdf': "application/pdf",
+        '.html': "text/html",
+        '.htm': "text/html",
+        '.txt': "text/plain",
+        '.md': "text/markdown",
+    }.get(path.suffix.lower(), "application/octet-stream")
+
+
+# Fetches the resources that records link to and extracts their text, keeping the results in the cache:
+class Harvester:
+    def __init__(self, settings: FullTextSettings):
+        self.settings = settings
+        self.session = Session()
+        adapter = HTTPAdapter(pool_maxsize=settings.workers, max_retries=1)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = "awindex full-text harvester"
+        self.lock = threading.Lock()
+        self.pool = None
+        self.counts = Counter()
+
+    def count(self, outcome: str, url: str = None, error: Exception = None):
+        with self.lock:
+            self.counts[outcome] += 1
+            warn = error is not None and self.counts[outcome] <= MAX_WARNINGS
+        if warn:
+            log.warning(f"Could not harvest the text of {url}: {error}")
+
+    # Extraction is CPU-bound, so happens in separate processes (only started if needed):
+    def extract(self, data: bytes, content_type: str) -> Optional[str]:
+        with self.lock:
+            if self.pool is None:
+                # Spawn fresh processes, as forking from a threaded process is unsafe:
+                self.pool = ProcessPoolExecutor(max_workers=self.settings.processes, mp_context=multiprocessing.get_context("spawn"))
+        return self.pool.submit(extract_text, data, content_type, self.settings.max_chars).result()
+
+    # Where to find a copy of the resource in one of the mirrors, if there is one:
+    def local_path(self, url: str) -> Optional[Path]:
+        for prefix, directory in (self.settings.mirrors or {}).items():
+            if url.startswith(prefix):
+                root = Path(directory).resolve()
+                path = (root / unquote(url[len(prefix):].split("?")[0].split("#")[0])).resolve()
+                # Never read anything from outside the mirror:
+                if not path.is_relative_to(root):
+                    raise Exception(f"The path {path} is outside the mirror {root}")
+                return path
+        return None
+
+    def harvest(self, url: str) -> Optional[str]:
+        cache = get_cache()
+        key = ("full-text", url)
+        try:
+            path = self.local_path(url)
+        except Exception as e:
+            self.count('failed', url, e)
+            return None
+        # A text extracted with different limits, or from a different copy, has to be extracted again:
+        made_with = [self.settings.max_bytes, self.settings.max_chars, str(path) if path else url]
+        entry = cache.get(key, None)
+        if entry and entry.get('made_with', None) != made_with:
+            entry = None
+        if entry and time.time() - entry['checked'] < self.settings.check_for:
+            self.count('cached')
+            return entry['text']
+        try:
+            if path is not None:
+                data, content_type, validators = self.read_file(path, entry)
+            else:
+                data, content_type, validators = self.download(url, entry)
+        except Exception as e:
+            self.count('failed', url, e)
+            return entry['text'] if entry else None
+        # Re-use the text if the resource hasn't changed since it was extracted:
+        if data is None:
+            self.count('unchanged')
+            entry['checked'] = time.time()
+            cache.set(key, entry)
+            return entry['text']
+        try:
+            text = self.extract(data, content_type)
+        except Exception as e:
+            self.count('failed', url, e)
+            text = None
+        self.count('extracted' if text else 'empty')
+        cache.set(key, { 'text': text, 'checked': time.time(), 'made_with': made_with, **validators })
+        return text
+
+    # Read a local copy, unless it's not changed since last time (in which case there's no data):
+    def read_file(self, path: Path, entry: Optional[dict]):
+        stat = path.stat()
+        validators = { 'modified': f"{stat.st_mtime_ns}-{stat.st_size}" }
+        if entry and entry.get('modified', None) == validators['modified']:
+            return None, None, validators
+        with open(path, "rb") as f:
+            return f.read(self.settings.max_bytes), guess_content_type(path), validators
+
+    # Download a resource, unless it's not changed since last time (in which case there's no data):
+    def download(self, url: str, entry: Optional[dict]):
+        headers = {}
+        if entry and entry.get('etag', None):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified', None):
+            headers['If-Modified-Since'] = entry['last_modified']
+        with self.session.get(url, headers=headers, timeout=self.settings.timeout, stream=True) as r:
+            validators = { 'etag': r.headers.get('ETag', None), 'last_modified': r.headers.get('Last-Modified', None) }
+            if r.status_code == 304 and entry:
+                return None, None, validators
+            r.raise_for_status()
+            # Don't download more than is needed:
+            data = bytearray()
+            for chunk in r.iter_content(chunk_size=64*1024):
+                data += chunk
+                if len(data) >= self.settings.max_bytes:
+                    break
+            return bytes(data[:self.settings.max_bytes]), r.headers.get('Content-Type', ""), validators
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+def wants_full_text(ir: Record, settings: FullTextSettings) -> bool:
+    # Only resources on the web are harvested (or their copies in the mirrors), never arbitrary local files:
+    if ir.full_text or urlsplit(ir.url).scheme not in ('http', 'https'):
+        return False
+    if settings.sources and ir.source not in settings.sources:
+        return False
+    # No point trying links that are known not to work:
+    return (ir.metadata or {}).get('link_health', None) not in ('broken', 'unreachable')
+
+# Fill in the full text of the records as they pass through, keeping many on the go but the records in order:
+def harvest_full_text(records: Iterator[Record], settings: FullTextSettings) -> Iterator[Record]:
+    harvester = Harvester(settings)
+    harvests = lookahead(records, lambda ir: harvester.harvest(ir.url), settings.workers, lambda ir: wants_full_text(ir, settings))
+    # (Closing the harvests first, so nothing is still being extracted when the harvester is closed)
+    with closing(harvester), closing(harvests):
+        for ir, text in harvests:
+            if text:
+                ir.full_text = text
+            yield ir
+    summary = ", ".join(f"{count} {outcome}" for outcome, count in harvester.counts.most_common())
+    log.info(f"Harvested full text: {summary or 'nothing to do'}.")
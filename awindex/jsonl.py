@@ -0,0 +1,106 @@
+import io
+import os
+import gzip
+import hashlib
+import logging
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+from pydantic import ValidationError
+from .models import IndexRecord, Record, Jsonl, SourceResults
+
+log = logging.getLogger(__name__)
+
+# How many lines to hand to each worker process at a time:
+CHUNK_LINES = 2000
+# Only keep this many warnings about bad lines, although they are all counted:
+MAX_WARNINGS = 100
+
+
+def open_jsonl(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(f"Reading {path} requires the zstandard package, e.g. pip install awindex[zstd]")
+        # The decompressor is a raw stream, so needs buffering to be read line by line:
+        return io.BufferedReader(zstandard.open(path, "rb"))
+    return open(path, "rb")
+
+# Hash the (compressed) file, so any change to it is spotted:
+def jsonl_version(source: Jsonl) -> str:
+    h = hashlib.sha256()
+    with open(source.file, "rb") as f:
+        while chunk := f.read(1024*1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+def read_chunks(f) -> Iterator[Tuple[int, List[bytes]]]:
+    line_number = 1
+    while chunk := list(itertools.islice(f, CHUNK_LINES)):
+        yield line_number, chunk
+        line_number += len(chunk)
+
+# Validate a chunk of lines (in a worker process), returning the records and any errors:
+def validate_lines(line_number: int, lines: List[bytes], name: str, homepage: str):
+    records = []
+    errors = []
+    for i, line in enumerate(lines, start=line_number):
+        if not line.strip():
+            continue
+        try:
+            ir = IndexRecord.model_validate_json(line)
+        except ValidationError as e:
+            error = e.errors()[0]
+            location = ".".join(str(l) for l in error['loc'])
+            errors.append((i, f"{location} {error['msg']}" if location else error['msg']))
+            continue
+        # Override the source field:
+        ir.source = name
+        ir.source_url = homepage
+        # Compact records are also much quicker to send back from the worker processes:
+        records.append(Record.from_index_record(ir))
+    return records, errors
+
+
+def parse_jsonl(source: Jsonl, result: SourceResults) -> Iterator[Record]:
+    processes = source.processes or os.cpu_count() or 1
+    with open_jsonl(source.file) as f:
+        chunks = read_chunks(f)
+        # Look ahead, to see if there's more than one chunk:
+        head = list(itertools.islice(chunks, 2))
+        chunks = itertools.chain(head, chunks)
+        if len(head) < 2 or processes == 1:
+            # Not worth starting up worker processes:
+            validated = (validate_lines(n, lines, source.name, source.homepage) for n, lines in chunks)
+            yield from report(source, result, validated)
+            return
+        # Spawn fresh processes, as forking from a threaded process is unsafe:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+            yield from report(source, result, validate_in_pool(pool, processes, source, chunks))
+
+# Keep a few chunks per process on the go, but hand the results back in order:
+def validate_in_pool(pool: ProcessPoolExecutor, processes: int, source: Jsonl, chunks):
+    pending = deque()
+    for line_number, lines in chunks:
+        pending.append(pool.submit(validate_lines, line_number, lines, source.name, source.homepage))
+        if len(pending) >= processes * 2:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def report(source: Jsonl, result: SourceResults, validated) -> Iterator[Record]:
+    for records, errors in validated:
+        for line_number, message in errors:
+            result.num_errors += 1
+            warning = f"Skipped line {line_number} of {source.file}: {message}"
+            log.warning(warning)
+            if len(result.warnings) < MAX_WARNINGS:
+                result.warnings.append(warning)
+        for ir in records:
+            result.num_records += 1
+            yield ir
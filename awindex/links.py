@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlsplit
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
+from .models import Record, LinkCheckSettings
+from .cache import get_cache
+from .utils import lookahead
+
+log = logging.getLogger(__name__)
+
+# Some servers refuse HEAD requests, so these get a second try with GET:
+RETRY_WITH_GET = {403, 404, 405, 501}
+
+
+# Checks links, with a limit on how many requests go to any one host at once, and how often:
+class LinkChecker:
+    def __init__(self, settings: LinkCheckSettings):
+        self.settings = settings
+        # Don't retry, as a slow or dead host would hold everything up:
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=settings.workers, pool_maxsize=settings.per_host, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = "awindex link checker"
+        self.lock = threading.Lock()
+        self.hosts: Dict[str, threading.BoundedSemaphore] = {}
+        self.next_request: Dict[str, float] = {}
+        self.counts = Counter()
+        # When the first of the results used goes out of date:
+        self.valid_until: Optional[float] = None
+
+    def host_slot(self, host: str) -> threading.BoundedSemaphore:
+        with self.lock:
+            return self.hosts.setdefault(host, threading.BoundedSemaphore(self.settings.per_host))
+
+    # Wait until it's this host's turn again:
+    def wait_for_host(self, host: str):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request.get(host, now))
+            self.next_request[host] = start + self.settings.host_delay
+        if start > now:
+            time.sleep(start - now)
+
+    def request(self, url: str) -> dict:
+        host = (urlsplit(url).hostname or "").lower()
+        with self.host_slot(host):
+            self.wait_for_host(host)
+            try:
+                r = self.session.head(url, allow_redirects=True, timeout=self.settings.timeout)
+                if r.status_code in RETRY_WITH_GET:
+                    self.wait_for_host(host)
+                    # (Streaming, so only the headers are downloaded)
+                    with self.session.get(url, allow_redirects=True, timeout=self.settings.timeout, stream=True) as r:
+                        pass
+            except RequestException as e:
+                return { 'health': 'unreachable', 'status': type(e).__name__, 'url': None }
+        if r.status_code < 400:
+            health = 'ok'
+        elif r.status_code == 429:
+            # Rate-limited, so we don't actually know:
+            health = 'unknown'
+        else:
+            health = 'broken'
+        return { 'health': health, 'status': str(r.status_code), 'url': r.url }
+
+    def note_expiry(self, expire_time: Optional[float]):
+        with self.lock:
+            if expire_time is not None and (self.valid_until is None or expire_time < self.valid_until):
+                self.valid_until = expire_time
+
+    def check(self, url: str) -> dict:
+        cache = get_cache()
+        key = ("link", url)
+        result, expire_time = cache.get(key, None, expire_time=True)
+        if result is not None:
+            self.note_expiry(expire_time)
+            with self.lock:
+                self.counts['cached'] += 1
+            return result
+        result = self.request(url)
+        result['checked'] = datetime.now().isoformat(timespec='seconds')
+        # Don't hold on to results that may just be a temporary problem for as long:
+        expire = self.settings.check_for if result['health'] in ('ok', 'broken') else self.settings.recheck_failures_after
+        cache.set(key, result, expire=expire)
+        self.note_expiry(time.time() + expire)
+        with self.lock:
+            self.counts['checked'] += 1
+        return result
+
+def add_link_health(ir: Record, result: dict):
+    ir.metadata = {
+        **(ir.metadata or {}),
+        'link_health': result['health'],
+        'link_status': result['status'],
+        'link_checked': result['checked'],
+    }
+    # Note where the link actually ended up, if it was redirected:
+    if result['url'] and result['url'] != ir.url:
+        ir.links = { **(ir.links or {}), 'resolved': result['url'] }
+
+
+# Check the links of the records as they pass through, keeping many checks on the go but the records in order:
+def check_links(records: Iterator[Record], checker: LinkChecker) -> Iterator[Record]:
+    health = Counter()
+    for ir, result in lookahead(records, lambda ir: checker.check(ir.url), checker.settings.workers):
+        add_link_health(ir, result)
+        health[result['health']] += 1
+        yield ir
+    summary = ", ".join(f"{count} {h}" for h, count in health.most_common())
+    log.info(f"Checked {checker.counts['checked']} links and reused {checker.counts['cached']} earlier checks: {summary}.")
@@ -0,0 +1,146 @@
+import copy
+import hashlib
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .models import Record, Manifest
+from .exports import Sink, RECORD_SCHEMA, BATCH_SIZE
+from .registry import source_function
+
+log = logging.getLogger(__name__)
+
+# Build state is kept in a hidden folder in the output directory:
+BUILD_DIR = ".awindex"
+# (Changed whenever the saved state or the export formats change, so older builds are redone from scratch)
+MANIFEST_VERSION = 4
+
+
+def load_manifest(output_path: Path) -> Manifest:
+    manifest_file = output_path / BUILD_DIR / "manifest.json"
+    if manifest_file.exists():
+        manifest = Manifest.model_validate_json(manifest_file.read_text())
+        if manifest.version == MANIFEST_VERSION:
+            return manifest
+        log.warning("Ignoring build manifest from an older version of awindex.")
+    return Manifest(version=MANIFEST_VERSION)
+
+def save_manifest(output_path: Path, manifest: Manifest):
+    manifest_file = output_path / BUILD_DIR / "manifest.json"
+    manifest_file.parent.mkdir(parents=True, exist_ok=True)
+    manifest.version = MANIFEST_VERSION
+    manifest_file.write_text(manifest.model_dump_json(indent=2))
+
+# Fingerprint the current content of a source, without parsing it:
+def source_fingerprint(source) -> Optional[str]:
+    h = hashlib.sha256(source.model_dump_json().encode())
+    version = source_function(source.type, 'version')
+    if version is None:
+        return None
+    try:
+        h.update(version(source).encode())
+    except Exception as e:
+        # If we can't tell, the source will just get rebuilt:
+        log.warning(f"Could not fingerprint source {source.name}: {e}")
+        return None
+    return h.hexdigest()
+
+# Fingerprint a whole build from the fingerprints of its sources, in order:
+def build_fingerprint(fingerprints: Dict[str, Optional[str]]) -> Optional[str]:
+    h = hashlib.sha256(str(MANIFEST_VERSION).encode())
+    for name, fp in fingerprints.items():
+        if fp is None:
+            return None
+        h.update(f"{name}\n{fp}\n".encode())
+    return h.hexdigest()
+
+# Each source's records are kept as a separate Parquet file, so they can be replayed into later builds.
+# Arrow would turn dates into naive UTC timestamps, so they are kept as ISO strings, with any timezone they had:
+PART_SCHEMA = RECORD_SCHEMA.set(RECORD_SCHEMA.get_field_index("date"), pa.field("date", pa.string()))
+
+def part_path(output_path: Path, name: str) -> Path:
+    key = hashlib.sha1(name.encode()).hexdigest()
+    return output_path / BUILD_DIR / "parts" / f"{key}.parquet"
+
+def read_source_part(path: Path) -> Iterator[Record]:
+    # Sources with no records don't get a part file:
+    if not path.exists():
+        return
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=BATCH_SIZE):
+        for item in batch.to_pylist():
+            # Arrow hands maps back as lists of pairs:
+            for field in ['metadata', 'links']:
+                if item[field] is not None:
+                    item[field] = dict(item[field])
+            if item['date'] is not None:
+                item['date'] = datetime.fromisoformat(item['date'])
+            # These were validated when they were first parsed:
+            yield Record.from_dict(item)
+
+
+# Sink that writes the records of the given sources out to their part files:
+class SourcePartsSink(Sink):
+    name = "source parts"
+
+    def __init__(self, output_path: Path, sources: Set[str]):
+        self.output_path = output_path
+        self.sources = sources
+        self.source = None
+        self.writer = None
+        self.batch = []
+        # Make sure rebuilt sources with no records don't leave an old part behind:
+        for name in sources:
+            part_path(output_path, name).unlink(missing_ok=True)
+
+    def add(self, ir: Record):
+        if ir.source not in self.sources:
+            return
+        if ir.source != self.source:
+            self.close()
+            path = part_path(self.output_path, ir.source)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = pq.ParquetWriter(path, PART_SCHEMA)
+            self.source = ir.source
+        fields = ir.to_dict()
+        if ir.date is not None:
+            fields['date'] = ir.date.isoformat()
+        self.batch.append(fields)
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_table(pa.Table.from_pylist(self.batch, schema=PART_SCHEMA))
+            self.batch = []
+
+    def close(self):
+        if self.writer:
+            self.flush()
+            self.writer.close()
+            self.writer = None
+            self.source = None
+
+    # The part being written is incomplete, so drop it (the source will be rebuilt next time):
+    def abort(self):
+        if self.writer:
+            self.writer.close()
+            part_path(self.output_path, self.source).unlink(missing_ok=True)
+            self.writer = None
+            self.source = None
+
+
+# Sink that keeps a copy of each source's records in memory (e.g. between the builds of awindex watch):
+class SourceMemorySink(Sink):
+    name = "source memory"
+
+    def __init__(self, memory: Dict[str, List[Record]]):
+        self.memory = memory
+
+    def add(self, ir: Record):
+        # Copied, as later stages may change the records:
+        self.memory.setdefault(ir.source, []).append(copy.copy(ir))
+
+    def close(self):
+        pass
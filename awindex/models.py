@@ -1,6 +1,8 @@
+import sys
 import json
+from dataclasses import dataclass
 from typing import List, Optional, Set, Dict, Tuple, Type, Union, Literal, Annotated
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from datetime import datetime
 
 # Data model of normalised form of index record:
@@ -25,12 +27,65 @@ class IndexRecord(BaseModel):
     language: str = "en"
     source: str
     source_url: str
+    # All the sources this record was found in, if merged from several:
+    sources: Optional[List[str]] = None
+
+# Compact form of an IndexRecord, used to pass records from the parsers to the exports once they have been validated.
+# Slots avoid a dict per record, and frequently repeated strings are interned so each value is only held once:
+@dataclass(slots=True, kw_only=True)
+class Record:
+    title: str
+    url: str
+    creators: Optional[List[str]] = None
+    abstract: Optional[str] = None
+    full_text: Optional[str] = None
+    type: Optional[str] = None
+    categories: Optional[List[str]] = None
+    keywords: Optional[List[str]] = None
+    license: Optional[str] = None
+    date: Optional[datetime] = None
+    weight: Optional[int] = None
+    metadata: Optional[Dict[str, str]] = None
+    links: Optional[Dict[str, str]] = None
+    language: str = "en"
+    source: str
+    source_url: str
+    sources: Optional[List[str]] = None
+
+    @staticmethod
+    def from_index_record(ir: IndexRecord) -> "Record":
+        # Iterating over the model gives the fields without copying them as model_dump() would:
+        return Record.from_dict(dict(ir))
+
+    # Build a record from trusted data, i.e. without validating it again:
+    @staticmethod
+    def from_dict(fields: dict) -> "Record":
+        record = Record(**fields)
+        for name in ('type', 'license', 'language', 'source', 'source_url'):
+            if (value := getattr(record, name)) is not None:
+                setattr(record, name, sys.intern(value))
+        for name in ('categories', 'keywords', 'sources'):
+            if values := getattr(record, name):
+                setattr(record, name, [sys.intern(v) for v in values])
+        return record
+
+    def to_dict(self) -> dict:
+        return { name: getattr(self, name) for name in RECORD_FIELDS }
+
+    def to_index_record(self) -> IndexRecord:
+        return IndexRecord.model_construct(**self.to_dict())
+
+RECORD_FIELDS = list(IndexRecord.model_fields)
+assert RECORD_FIELDS == list(Record.__dataclass_fields__), "Record and IndexRecord fields must match"
+
 
 # Data model for input configuration, and storing results temporarily:
 class Source(BaseModel):
     name: str
     homepage: str
     description: Optional[str] = None
+    # How long to keep downloads from this source in the cache, in seconds:
+    cache_for: Optional[int] = None
 
 # Awesome List Source:
 class Awesome(Source):
@@ -54,7 +109,58 @@ class Zenodo(Source):
 # JSONL local file source
 class Jsonl(Source):
     type: Literal['jsonl']
+    # May be compressed, with a .gz or .zst extension:
     file: str
+    # How many processes to use to validate the records, defaulting to one per CPU:
+    processes: Optional[int] = None
+
+# Options for the Parquet export:
+class ParquetSettings(BaseModel):
+    # Number of records in each row group:
+    row_group_size: int = 50000
+    compression: str = 'zstd'
+    compression_level: Optional[int] = None
+    # Also write a dataset partitioned by source and year:
+    partitioned: bool = False
+
+# Options for checking the links of the records:
+class LinkCheckSettings(BaseModel):
+    # How many links to check at once, and how many of those can be on the same host:
+    workers: int = 32
+    per_host: int = 2
+    # Minimum number of seconds between requests to the same host:
+    host_delay: float = 0.0
+    timeout: float = 10.0
+    # How long to keep the result of a check before checking again, in seconds:
+    check_for: int = 60*60*24*7
+    # Unreachable or rate-limited links are checked again sooner:
+    recheck_failures_after: int = 60*60*24
+
+# Options for harvesting the text of the resources that records link to:
+class FullTextSettings(BaseModel):
+    # How many resources to download at once, and how many processes to extract the text in (default: one per CPU):
+    workers: int = 8
+    processes: Optional[int] = None
+    # Limits on how much of each resource to download, and how much of the text to keep:
+    max_bytes: int = 20*1024*1024
+    max_chars: int = 100000
+    timeout: float = 30.0
+    # How long to trust a harvested text before checking whether the resource has changed, in seconds:
+    check_for: int = 60*60*24*7
+    # Local copies of resources, mapping URL prefixes to directories, e.g. { "https://example.org/files/": "/data/files" }:
+    mirrors: Optional[Dict[str, str]] = None
+    # Only harvest the records of these sources (default: all of them):
+    sources: Optional[List[str]] = None
+
+# Options for the download cache:
+class CacheSettings(BaseModel):
+    directory: str = ".data_cache"
+    # Once the cache is bigger than this, the least recently used entries are dropped:
+    size_limit_mb: int = 1024
+    # How long to keep downloads, unless a source sets its own cache_for:
+    expire: int = 60*60*24
+    # Entries bigger than this many bytes are compressed:
+    compress_threshold: int = 1024
 
 # Config file spec:
 class Settings(BaseModel):
@@ -62,8 +168,60 @@ class Settings(BaseModel):
     homepage: Optional[str] = None
     description: Optional[str] = None
     output: Optional[str] = './index'
+    # How many sources to fetch and parse at the same time:
+    workers: int = 4
+    # Optional per-source-type limits on concurrent fetches, e.g. { zotero: 1 }:
+    concurrency: Optional[Dict[str, int]] = None
+    # How many processes to run the exports in, defaulting to one per export (up to one per CPU):
+    export_processes: Optional[int] = None
+    # Optionally split the PageFind index into separate bundles by source or by a record field:
+    pagefind_shards: Optional[Literal['source', 'type', 'year', 'language']] = None
+    # Merge records with the same URL or DOI from different sources:
+    deduplicate: bool = False
+    parquet: ParquetSettings = ParquetSettings()
+    cache: CacheSettings = CacheSettings()
+    # If set, check whether each record's link still works:
+    check_links: Optional[LinkCheckSettings] = None
+    # If set, add the text of the linked resources to records that don't have any:
+    full_text: Optional[FullTextSettings] = None
     sources: List[Annotated[Union[Awesome, Zenodo, Zotero, Jsonl], Field(discriminator='type')]]
 
+    # The build state (saved records, database patches, dataset partitions) is kept per source name, so names must be unique:
+    @field_validator('sources')
+    @classmethod
+    def unique_source_names(cls, sources):
+        names = [source.name for source in sources]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Each source must have a different name, but these are used more than once: {', '.join(duplicates)}")
+        return sources
+
+
+# Build instrumentation:
+class StageStats(BaseModel):
+    name: str
+    seconds: float = 0.0
+    records: Optional[int] = None
+    peak_rss_mb: Optional[float] = None
+
+class SourceStats(BaseModel):
+    # Time spent downloading (or checking the cache), and the remainder spent parsing:
+    fetch_seconds: float = 0.0
+    parse_seconds: float = 0.0
+    bytes_fetched: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # Whether the records were reused from the last build:
+    replayed: bool = False
+
+class BuildStats(BaseModel):
+    started: datetime
+    seconds: float = 0.0
+    records: int = 0
+    peak_rss_mb: Optional[float] = None
+    sources: Dict[str, SourceStats] = {}
+    stages: List[StageStats] = []
+
 
 # Class to hold the summary of a source along with the results:
 class SourceResults(Source):
@@ -71,4 +229,22 @@ class SourceResults(Source):
     warnings: Optional[List[str]] = None
     num_records: int = 0
     num_ignored: int = 0
-    num_errors: int = 0
\ No newline at end of file
+    num_errors: int = 0
+    stats: Optional[SourceStats] = None
+
+# Build manifest, recording what went into the last build so unchanged sources can be skipped:
+class SourceState(BaseModel):
+    fingerprint: Optional[str] = None
+    summary: SourceResults
+    # Which optional stages the saved records have been through, e.g. links-checked, full-text:
+    stages: List[str] = []
+
+class Manifest(BaseModel):
+    version: int = 1
+    # Fingerprint of the last complete build:
+    build: Optional[str] = None
+    sources: Dict[str, SourceState] = {}
+    # Which build each output was last generated by:
+    artifacts: Dict[str, str] = {}
+    # When the first of the link checks used by the last build goes out of date:
+    links_valid_until: Optional[datetime] = None
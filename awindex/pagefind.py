@@ -1,10 +1,19 @@
+import re
 import json
+import base64
+import shutil
 import asyncio
 import logging
-from typing import List, Optional, Set, Dict, Tuple, Type, Union, Literal, Annotated
+from pathlib import Path
+from typing import Iterable, List, Optional, Set, Dict, Tuple, Type, Union, Literal, Annotated
 from pydantic import BaseModel
-from pagefind.index import PagefindIndex, IndexConfig
-from .models import Settings, IndexRecord
+from pagefind.index import IndexConfig
+from pagefind.service import PagefindService
+from .models import IndexRecord, Record
+from .exports import Sink, write_records
+
+# The metadata fields added when the links are checked (see links.py):
+LINK_METADATA = ('link_health', 'link_status', 'link_checked')
 
 log = logging.getLogger(__name__)
 
@@ -21,87 +30,253 @@ class PageFindRecord(BaseModel):
 
     @staticmethod
     def from_index_record(ir: IndexRecord):
-        # Build a record:
-        pf = PageFindRecord(
-            url=ir.url,
-            content=f"{ir.title}",
-            meta={
-                'title': ir.title,
-            },
-            filters={},
-            sort={
-                'title': ir.title,
-            }
-        )
-        # Optional fields etc.:
-        if ir.abstract:
-            pf.content += f" {ir.abstract}"
-        if ir.full_text:
-            pf.content += f" {ir.full_text}"
-        if ir.creators and len(ir.creators) > 0:
-            summary = ", ".join(ir.creators)
-            pf.content += f" {summary}" # Ensures the values are searchable
-            pf.meta['creators'] = summary
-            pf.filters['creators'] = ir.creators
-        if ir.keywords and len(ir.keywords) > 0:
-            summary = ", ".join(ir.keywords)
-            pf.content += f" {summary}"  
-            pf.meta['keywords'] = summary
-            pf.filters['keywords'] = ir.keywords
-        if ir.categories:
-            pf.filters['categories'] = ir.categories
-            pf.meta['categories'] = ", ".join(ir.categories)
-        if ir.type:
-            pf.filters['type'] = [ ir.type ]
-            pf.meta['type'] = ir.type
+        return PageFindRecord(**pagefind_record(ir))
+
+
+# Map an IndexRecord to the arguments of add_custom_record, as a plain dict to avoid validation overhead:
+def pagefind_record(ir: Union[IndexRecord, Record]) -> dict:
+    # Build a record:
+    content = ir.title
+    meta = {
+        'title': ir.title,
+    }
+    filters = {}
+    sort = {
+        'title': ir.title,
+    }
+    # Optional fields etc.:
+    if ir.abstract:
+        content += f" {ir.abstract}"
+    if ir.full_text:
+        content += f" {ir.full_text}"
+    if ir.creators and len(ir.creators) > 0:
+        summary = ", ".join(ir.creators)
+        content += f" {summary}" # Ensures the values are searchable
+        meta['creators'] = summary
+        filters['creators'] = ir.creators
+    if ir.keywords and len(ir.keywords) > 0:
+        summary = ", ".join(ir.keywords)
+        content += f" {summary}"  
+        meta['keywords'] = summary
+        filters['keywords'] = ir.keywords
+    if ir.categories:
+        filters['categories'] = ir.categories
+        meta['categories'] = ", ".join(ir.categories)
+    if ir.type:
+        filters['type'] = [ ir.type ]
+        meta['type'] = ir.type
+    # Add the source(s):
+    if ir.sources:
+        filters['source'] = ir.sources
+        meta['source'] = ", ".join(ir.sources)
+    elif ir.source:
+        filters['source'] = [ ir.source ]
+        meta['source'] = ir.source
+    # If there's a date, filter on the year:
+    if ir.date:
+        filters['year'] = [ str(ir.date.year) ]
+        meta['date'] = ir.date.isoformat()
+        sort['date'] = ir.date.isoformat()
+    if ir.metadata:
+        # Let people filter out records with broken links:
+        if health := ir.metadata.get('link_health', None):
+            filters['link'] = [ health ]
+        for k,v in ir.metadata.items():
+            # The other link check details aren't worth searching on:
+            if k in LINK_METADATA:
+                continue
+            # If this looks like a JSON encoded array, try to load it as such and join it:
+            if v.startswith("[\""):
+                v = ", ".join(json.loads(v))
+            # Store the (resulting) value for search and for viewing:
+            content += f" {v}"  
+            meta[k] = v
+
+    # Other items to consider including:
+    #source_url: str
+    #license: Optional[str] = None
+    #weight: Optional[int] = None
+    #links: Optional[Dict[str, str]] = None
+
+    # Return the mapped object:
+    return {
+        'url': ir.url,
+        'content': content,
         # Add the language:
-        if ir.language:
-            pf.language = ir.language
-        # Add the source:
-        if ir.source:
-            pf.filters['source'] = [ ir.source ]
-            pf.meta['source'] = ir.source
-        # If there's a date, filter on the year:
-        if ir.date:
-            pf.filters['year'] = [ str(ir.date.year) ]
-            pf.meta['date'] = ir.date.isoformat()
-            pf.sort['date'] = ir.date.isoformat()
-        if ir.metadata:
-            for k,v in ir.metadata.items():
-                # If this looks like a JSON encoded array, try to load it as such and join it:
-                if v.startswith("[\""):
-                    v = ", ".join(json.loads(v))
-                # Store the (resulting) value for search and for viewing:
-                pf.content += f" {v}"  
-                pf.meta[k] = v
-
-        # Other items to consider including:
-        #source_url: str
-        #license: Optional[str] = None
-        #weight: Optional[int] = None
-        #links: Optional[Dict[str, str]] = None
-
-        # Return the mapped object:
-        return pf
-
-async def async_generator(index_path, records: List[IndexRecord]):
-    # Set up index config and generate:
-    log.info("Generating PageFind index...")
-    index_config = IndexConfig(
-        root_selector="main", output_path=str(index_path), verbose=False
-    )
-    async with PagefindIndex(config=index_config) as index:
-        # Add custom records:
-        count = 0
-        for ir in records:
-            pf = PageFindRecord.from_index_record(ir)
-            await index.add_custom_record(**(dict(pf)))
-            count += 1
+        'language': ir.language or "en",
+        'meta': meta,
+        'filters': filters,
+        'sort': sort,
+    }
+
+
+# The standard PagefindService only checks for a response every 0.1s, which caps indexing at ten records a second.
+# This version reads each response as soon as it arrives, and forgets about requests once they are answered.
+# It overrides private parts of the service (mirroring pagefind 1.5.x, which is why pyproject.toml pins it to that version).
+class PipelinedPagefindService(PagefindService):
+    async def _wait_for_responses(self) -> None:
+        while True:
+            output = await self._backend.stdout.readuntil(b",")
+            if (resp := json.loads(base64.b64decode(output[:-1]))) is None:
+                continue
+            message_id = resp.get("message_id")
+            if message_id is None:
+                # If the service failed to parse the message, it returns the message itself, which has the ID:
+                if (original := resp["payload"].get("original_message")) is not None:
+                    if (sent := json.loads(original)) is not None:
+                        message_id = sent.get("message_id")
+            if (future := self._responses.pop(message_id, None)) is None:
+                log.debug(f"No request waiting for PageFind response {resp}")
+                continue
+            payload = resp["payload"]
+            if payload["type"] == "Error":
+                future.set_exception(Exception(payload["message"], payload.get("original_message")))
+            else:
+                future.set_result(payload)
+
+    # Stop the service straight away, without waiting for any outstanding responses:
+    async def terminate(self) -> None:
+        self._poll_task.cancel()
+        self._backend.terminate()
+        await self._backend.wait()
+
+
+# Which shard a record belongs in, when splitting the index up:
+def shard_key(ir: Record, shard_by: str) -> str:
+    if shard_by == 'year':
+        return str(ir.date.year) if ir.date else "undated"
+    return getattr(ir, shard_by, None) or "unknown"
+
+# Each shard is written out as a separate PageFind bundle in here:
+SHARDS_DIR = "pagefind-shards"
+
+def list_shards(output_path: Path) -> List[str]:
+    shards_path = output_path / SHARDS_DIR
+    if not shards_path.exists():
+        return []
+    return sorted(f"./{SHARDS_DIR}/{p.name}/" for p in shards_path.iterdir() if p.is_dir())
+
+
+# Sink that adds each record to a PageFind index as it goes by:
+class PagefindSink(Sink):
+    name = "PageFind"
+    # How many records can be waiting to be indexed at once:
+    max_in_flight = 100
+
+    def __init__(self, index_path, shard_by: str = None):
+        """
+        Args:
+            index_path (Path): Where to write the (first) PageFind bundle.
+            shard_by (str): If set, split the index into a bundle for each value of this field, e.g. 'source' or 'year'.
+        """
+        log.info("Generating PageFind index...")
+        self.index_path = Path(index_path)
+        self.shard_by = shard_by
+        self.shards_path = self.index_path.parent / SHARDS_DIR
+        # The PageFind API is async, so drive it from our own event loop:
+        self.loop = asyncio.new_event_loop()
+        # Each index has its own PageFind process:
+        self.indexes = {}
+        self.slugs = set()
+        self.pending = set()
+        self.count = 0
+
+    async def start(self, output_path: Path):
+        index_config = IndexConfig(
+            root_selector="main", output_path=str(output_path), verbose=False
+        )
+        service = await PipelinedPagefindService().launch()
+        return await service.create_index(index_config)
+
+    def get_index(self, ir: Record):
+        key = shard_key(ir, self.shard_by) if self.shard_by else None
+        if key not in self.indexes:
+            # The first shard is the main bundle, and the others are merged into it by the search page:
+            if len(self.indexes) == 0:
+                output_path = self.index_path
+            else:
+                slug = re.sub(r"[^a-z0-9]+", "-", key.lower()).strip("-") or "shard"
+                while slug in self.slugs:
+                    slug += "-"
+                self.slugs.add(slug)
+                output_path = self.shards_path / slug
+                log.info(f"Starting PageFind shard {slug} for {self.shard_by} '{key}'...")
+            self.indexes[key] = self.loop.run_until_complete(self.start(output_path))
+        return self.indexes[key]
+
+    def add(self, ir: Record):
+        # Send the record off, and carry on with the next one while PageFind indexes it:
+        index = self.get_index(ir)
+        self.pending.add(self.loop.create_task(index.add_custom_record(**pagefind_record(ir))))
+        self.count += 1
+        # The tasks only progress while the loop runs, so run it when enough have built up:
+        if len(self.pending) >= self.max_in_flight:
+            self.wait(asyncio.FIRST_COMPLETED)
+
+    def wait(self, return_when):
+        done, self.pending = self.loop.run_until_complete(asyncio.wait(self.pending, return_when=return_when))
+        # Raise any errors (having collected them all, so none go unreported):
+        errors = [task.exception() for task in done if not task.cancelled() and task.exception()]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            if self.pending:
+                self.wait(asyncio.ALL_COMPLETED)
+            # Always write out the main bundle, even if there were no records:
+            if not self.indexes:
+                self.indexes[None] = self.loop.run_until_complete(self.start(self.index_path))
+        except BaseException:
+            # Don't leave the PageFind processes running:
+            self.abort()
+            raise
         # Report (don't call get_files as it returns the actual files and locks up the pipes):
-        log.info(f"Indexed {count} records, now writing PageFind index files...")
-    log.info("Indexing complete.")
+        log.info(f"Indexed {self.count} records into {len(self.indexes)} index(es), now writing PageFind index files...")
+        # Clear out any shards from a previous build, then write out all the shards at once:
+        shutil.rmtree(self.shards_path, ignore_errors=True)
+        try:
+            self.loop.run_until_complete(self.finish())
+        finally:
+            self.loop.close()
+        log.info("Indexing complete.")
+
+    # Stop indexing, leaving the last build's index files as they were:
+    def abort(self):
+        if self.loop.is_closed():
+            return
+        for task in self.pending:
+            task.cancel()
+        try:
+            self.loop.run_until_complete(self.stop())
+        finally:
+            self.pending = set()
+            self.loop.close()
+
+    async def stop(self):
+        await asyncio.gather(
+            *self.pending,
+            *(index._service.terminate() for index in self.indexes.values()),
+            return_exceptions=True,
+        )
+
+    async def finish(self):
+        # Let every bundle finish (or its service be stopped) before reporting any failure:
+        results = await asyncio.gather(*(self.write_index(index) for index in self.indexes.values()), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def write_index(self, index):
+        service = index._service
+        try:
+            await index.write_files()
+        except BaseException:
+            await service.terminate()
+            raise
+        await service.close()
 
 
 # Take the records and convert them into a PageFind index.
-def generate_pagefind_index(config: Settings, records: List[IndexRecord]):
-    asyncio.run(async_generator(config, records))
\ No newline at end of file
+def generate_pagefind_index(index_path, records: Iterable[Record]):
+    write_records(records, [PagefindSink(index_path)])
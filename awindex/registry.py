@@ -0,0 +1,49 @@
+import importlib
+from typing import Callable, Optional
+
+# Where to find the code for each type of source, so only the modules a config actually uses get imported.
+# Each has a 'parse' function that yields its records, a 'version' function that returns a string that changes
+# whenever the source does, and optionally a 'warm' function that downloads it into the cache:
+SOURCES = {
+    'awesome-list': {
+        'parse': 'awindex.awelist:parse_awesome_list',
+        'version': 'awindex.awelist:awesome_list_version',
+        'warm': 'awindex.awelist:awesome_list_version',
+    },
+    'zotero': {
+        'parse': 'awindex.zotero:parse_zotero',
+        'version': 'awindex.zotero:zotero_version',
+        'warm': 'awindex.zotero:warm_zotero',
+    },
+    'zenodo': {
+        'parse': 'awindex.zenodo:parse_zenodo',
+        'version': 'awindex.zenodo:zenodo_version',
+        'warm': 'awindex.zenodo:warm_zenodo',
+    },
+    'jsonl': {
+        'parse': 'awindex.jsonl:parse_jsonl',
+        'version': 'awindex.jsonl:jsonl_version',
+    },
+}
+
+# And the sink that writes each output format:
+SINKS = {
+    'jsonl': 'awindex.exports:JsonlSink',
+    'sqlite': 'awindex.exports:SqliteSink',
+    'parquet': 'awindex.exports:ParquetSink',
+    'parquet-dataset': 'awindex.exports:PartitionedParquetSink',
+    'pagefind': 'awindex.pagefind:PagefindSink',
+    'facets': 'awindex.facets:FacetsSink',
+}
+
+
+def load(path: str):
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)
+
+def source_function(source_type: str, role: str) -> Optional[Callable]:
+    path = SOURCES.get(source_type, {}).get(role, None)
+    return load(path) if path else None
+
+def sink_class(output_format: str):
+    return load(SINKS[output_format])
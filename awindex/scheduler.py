@@ -0,0 +1,87 @@
+import os
+import pickle
+import logging
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterator, List
+from concurrent.futures import ProcessPoolExecutor
+from .models import Record, BuildStats, StageStats
+from .exports import Sink, write_records, BATCH_SIZE
+
+log = logging.getLogger(__name__)
+
+
+def sink_name(make_sink: Callable[[], Sink]) -> str:
+    return getattr(getattr(make_sink, 'func', make_sink), 'name', "sink")
+
+# The records are buffered as pickled batches, which keep every value exactly as it was parsed:
+def read_buffer(buffer_path: Path) -> Iterator[Record]:
+    with open(buffer_path, "rb") as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+# Run a sink over the buffered records (in a worker process):
+def run_sink(make_sink: Callable[[], Sink], buffer_path: Path, log_level: int) -> List[StageStats]:
+    logging.basicConfig(level=log_level)
+    stats = BuildStats(started=datetime.now())
+    write_records(read_buffer(buffer_path), [make_sink()], stats)
+    return stats.stages
+
+
+# Sink that collects the records into a buffer file, then runs each of the given sinks over them in its own process.
+# The sinks are passed as callables that create them (e.g. functools.partial), so they are only set up in the workers:
+class ParallelSinks(Sink):
+    name = "parallel exports"
+
+    def __init__(self, sinks: List[Callable[[], Sink]], buffer_path: Path, processes: int = None, stats: BuildStats = None):
+        self.sinks = sinks
+        self.buffer_path = buffer_path
+        self.processes = processes or min(len(sinks), os.cpu_count() or 1)
+        self.stats = stats
+        self.buffer_path.parent.mkdir(parents=True, exist_ok=True)
+        self.fh = open(self.buffer_path, "wb")
+        self.batch = []
+
+    def add(self, ir: Record):
+        self.batch.append(ir)
+        if len(self.batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            pickle.dump(self.batch, self.fh, protocol=pickle.HIGHEST_PROTOCOL)
+            self.batch = []
+
+    def abort(self):
+        self.fh.close()
+        self.buffer_path.unlink(missing_ok=True)
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+        log.info(f"Running {len(self.sinks)} exports across {self.processes} processes...")
+        failed = []
+        try:
+            # Spawn fresh processes, as forking from a threaded process is unsafe:
+            with ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [
+                    pool.submit(run_sink, make_sink, self.buffer_path, logging.getLogger().level)
+                    for make_sink in self.sinks
+                ]
+                # Let every export finish, even if one of them fails:
+                for make_sink, future in zip(self.sinks, futures):
+                    try:
+                        stages = future.result()
+                        if self.stats:
+                            self.stats.stages.extend(stages)
+                    except Exception as e:
+                        log.error(f"The {sink_name(make_sink)} export failed: {e}", exc_info=e)
+                        failed.append(sink_name(make_sink))
+        finally:
+            self.buffer_path.unlink(missing_ok=True)
+        if failed:
+            raise Exception(f"The {', '.join(failed)} export(s) failed.")
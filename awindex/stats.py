@@ -0,0 +1,63 @@
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from .models import BuildStats, StageStats, SourceStats
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows:
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# The stats of the source currently being worked on, if any:
+current_source: ContextVar[SourceStats] = ContextVar("current_source", default=None)
+lock = threading.Lock()
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, KB elsewhere:
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    return round(peak / 1024, 1)
+
+# Attribute any fetches in this block to the given source:
+@contextmanager
+def source_stats(stats: SourceStats):
+    token = current_source.set(stats)
+    try:
+        yield stats
+    finally:
+        current_source.reset(token)
+
+def record_fetch(seconds: float, size: int = 0, hit: bool = False):
+    stats = current_source.get()
+    if stats is None:
+        return
+    with lock:
+        stats.fetch_seconds += seconds
+        stats.bytes_fetched += size
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+# Time a stage of the build:
+@contextmanager
+def timed_stage(build: BuildStats, name: str):
+    stage = StageStats(name=name)
+    start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        stage.seconds = round(time.perf_counter() - start, 4)
+        stage.peak_rss_mb = peak_rss_mb()
+        build.stages.append(stage)
+        log.debug(f"Stage {name} took {stage.seconds} seconds.")
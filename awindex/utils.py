@@ -1,12 +1,97 @@
-from diskcache import Cache
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, Optional, Tuple
+from urllib3.util import Retry
+from requests import Session
+from requests.adapters import HTTPAdapter
+from .stats import record_fetch
+from .cache import get_cache, cache_expiry
 
-# Set up caching of calls to web services:
-cache = Cache(directory=".data_cache")
-CACHE_FOR_SECONDS = 60*60*24 # Cache for a day by default
+log = logging.getLogger(__name__)
+
+# Don't check the same URL again within a single run:
+FRESH_FOR_SECONDS = 60
+
+# Shared HTTP session, that retries on errors and backs off if rate-limited:
+session = Session()
+retries = Retry(
+    total=5,
+    backoff_factor=1.0,
+    status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True
+)
+session.mount('https://', HTTPAdapter(max_retries=retries))
+session.mount('http://', HTTPAdapter(max_retries=retries))
+
+# Fetch a URL, keeping the response in the cache and using its ETag/Last-Modified to check it is still current:
+def fetch_url(url, cache_for: int = None) -> str:
+    """
+    Args:
+        cache_for (int): How long to keep the response, in seconds, if not the cache's default.
+    """
+    cache = get_cache()
+    start = time.perf_counter()
+    key = ("fetch", url)
+    entry = cache.get(key, None)
+    if entry:
+        age = time.time() - entry['checked']
+        # Without validators, all we can do is re-use the response until it expires:
+        if age < FRESH_FOR_SECONDS or not (entry['etag'] or entry['last_modified']):
+            record_fetch(time.perf_counter() - start, hit=True)
+            return entry['body']
+    headers = {}
+    if entry and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    r = session.get(url, headers=headers)
+    hit = r.status_code == 304 and entry is not None
+    if hit:
+        log.debug(f"Not modified: {url}")
+    elif r.status_code == 200:
+        log.warning(f"Fetched {url}")
+        entry = {
+            'body': r.text,
+            'etag': r.headers.get('ETag', None),
+            'last_modified': r.headers.get('Last-Modified', None),
+        }
+    else:
+        raise Exception(f"FAILED: {r.status_code} {r.text}")
+    # Store or refresh the cached copy:
+    entry['checked'] = time.time()
+    cache.set(key, entry, expire=cache_expiry(cache_for))
+    record_fetch(time.perf_counter() - start, size=len(r.content), hit=hit)
+    return entry['body']
+
+def pass_on(pending: deque) -> Tuple[Any, Any]:
+    item, future = pending.popleft()
+    return item, future.result() if future is not None else None
+
+# Call a (slow) function for each of the records on a pool of threads, keeping many calls on the go but passing the
+# records on in order, each with its result. Records that aren't wanted are passed on with no result:
+def lookahead(records: Iterator[Any], call: Callable[[Any], Any], workers: int, wanted: Optional[Callable[[Any], bool]] = None) -> Iterator[Tuple[Any, Any]]:
+    pending = deque()
+    # Look far enough ahead that a run of slow calls (e.g. to one host) doesn't hold up the others for long:
+    window = workers * 100
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in records:
+                pending.append((item, pool.submit(call, item) if wanted is None or wanted(item) else None))
+                if len(pending) >= window:
+                    yield pass_on(pending)
+            while pending:
+                yield pass_on(pending)
+        finally:
+            # If the build is abandoned, don't wait for the rest:
+            for item, future in pending:
+                if future is not None:
+                    future.cancel()
 
 def uncomma_name(name):
     if ',' in name:
         surname, fornames = name.split(",", maxsplit=1)
         return f"{fornames.strip()} {surname.strip()}"
     else:
-        return name.strip()
\ No newline at end of file
+        return name.strip()
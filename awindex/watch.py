@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from yaml import YAMLError
+from pydantic import ValidationError
+from .models import Settings, Record, SourceResults
+from .cli import load_config, build_index, add_templated_files
+
+log = logging.getLogger(__name__)
+
+# Settings that only appear in the templates, so changing them doesn't need a rebuild:
+TEMPLATE_ONLY = {'title', 'description', 'homepage'}
+
+
+# The files on disk that a source is read from, if any:
+def source_files(source) -> List[Path]:
+    if source.type == 'jsonl':
+        return [Path(source.file)]
+    return []
+
+# When each watched file was last changed (or None if it's missing):
+def snapshot(config_file: str, config: Settings) -> Dict[Path, Optional[Tuple[int, int]]]:
+    paths = [Path(config_file)] + [path for source in config.sources for path in source_files(source)]
+    files = {}
+    for path in paths:
+        try:
+            stat = path.stat()
+            files[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            files[path] = None
+    return files
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+def serve(directory: Path, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("localhost", port), partial(QuietHandler, directory=str(directory)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Keeps the state of the last build, so each change only redoes what it affects:
+class Watcher:
+    def __init__(self, config_file: str, config: Settings, jsonl: bool = False, output: str = None, workers: int = None):
+        self.config_file = config_file
+        self.config = config
+        self.jsonl = jsonl
+        self.output = output
+        self.workers = workers
+        # The records of each source, and the fingerprints of sources not known to have changed since:
+        self.memory: Dict[str, List[Record]] = {}
+        self.fingerprints: Dict[str, str] = {}
+        self.results: List[SourceResults] = []
+
+    def build(self, full: bool = False):
+        start = time.perf_counter()
+        try:
+            self.results = build_index(self.config, full=full, jsonl=self.jsonl, memory=self.memory, known_fingerprints=self.fingerprints)
+        except Exception as e:
+            log.error(f"The build failed: {e}", exc_info=e)
+            return
+        log.info(f"Index updated in {time.perf_counter() - start:.2f} seconds.")
+
+    def render(self):
+        from .pagefind import list_shards
+        from .facets import load_facets
+        output_path = Path(self.config.output)
+        add_templated_files(self.config, self.results, output_path, ["index.html", "styles.css"], list_shards(output_path), load_facets(output_path))
+        log.info("Index page updated.")
+
+    def reload_config(self) -> Optional[Settings]:
+        try:
+            return load_config(self.config_file, self.output, self.workers)
+        except (OSError, YAMLError, ValidationError) as e:
+            log.error(f"Could not load {self.config_file}, so keeping the last good config: {e}")
+            return None
+
+    def update(self, changed: Set[Path]):
+        rebuild = False
+        if Path(self.config_file) in changed:
+            config = self.reload_config()
+            if config is None:
+                return
+            previous = self.config
+            self.config = config
+            if config.model_dump(exclude=TEMPLATE_ONLY) == previous.model_dump(exclude=TEMPLATE_ONLY):
+                self.render()
+                return
+            # Sources with different settings have to be checked again:
+            before = { source.name: source for source in previous.sources }
+            for source in config.sources:
+                if source.name not in before or source != before[source.name]:
+                    self.fingerprints.pop(source.name, None)
+            rebuild = True
+        for source in self.config.sources:
+            if changed & set(source_files(source)):
+                log.info(f"Source {source.name} has changed.")
+                self.fingerprints.pop(source.name, None)
+                rebuild = True
+        if rebuild:
+            self.build()
+
+
+# Build the index, then keep it up to date as the config or local sources are edited, serving it locally meanwhile:
+def watch(config_file: str, config: Settings, port: int = 8000, interval: float = 1.0, full: bool = False, jsonl: bool = False, output: str = None, workers: int = None):
+    watcher = Watcher(config_file, config, jsonl=jsonl, output=output, workers=workers)
+    watcher.build(full=full)
+    server = None
+    if port:
+        server = serve(Path(config.output), port)
+        log.info(f"Serving the index at http://localhost:{server.server_port}/")
+    log.info(f"Watching {config_file} and the local sources for changes (press Ctrl+C to stop)...")
+    seen = snapshot(config_file, watcher.config)
+    try:
+        while True:
+            time.sleep(interval)
+            now = snapshot(config_file, watcher.config)
+            if now == seen:
+                continue
+            # Wait for the files to settle, as editors may write them in several steps:
+            while True:
+                time.sleep(interval)
+                settled = snapshot(config_file, watcher.config)
+                if settled == now:
+                    break
+                now = settled
+            changed = { path for path in set(now) | set(seen) if now.get(path) != seen.get(path) }
+            watcher.update(changed)
+            # The config may have added or removed sources, and anything edited during the build is picked up next time round:
+            seen = { path: now[path] if path in now else stamp for path, stamp in snapshot(config_file, watcher.config).items() }
+    except KeyboardInterrupt:
+        log.info("Stopped watching.")
+    finally:
+        if server:
+            server.shutdown()
@@ -1,44 +1,67 @@
 import json
+import math
 import datetime
+import itertools
 import logging
-from urllib3.util import Retry
-from requests import Session
-from requests.adapters import HTTPAdapter
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
 
 from .models import IndexRecord, Zenodo, SourceResults
-from .utils import uncomma_name, cache, CACHE_FOR_SECONDS
-
-s = Session()
-retries = Retry(
-    total=5,
-    backoff_factor=1.0,
-    status_forcelist=[429, 500, 502, 503, 504]
-)
-s.mount('https://', HTTPAdapter(max_retries=retries))
+from .utils import uncomma_name, fetch_url
 
 log = logging.getLogger(__name__)
 
-@cache.memoize(expire=CACHE_FOR_SECONDS)
-def get_zenodo_url(url):
-    log.warning(f"Fetching {url}")
-    r = s.get(url)
-    if r.status_code != 200:
-        raise Exception(f"FAILED: {r.status_code} {r.text}")
-    return r.text
+def get_zenodo_url(url, cache_for: int = None):
+    return fetch_url(url, cache_for)
+
+# Largest page size Zenodo allows, and how many pages to fetch at once:
+PAGE_SIZE = 100
+PAGE_WORKERS = 4
 
 # https://zenodo.org/api/communities/digital-preservation/records?page=2&size=25&sort=newest
-def get_zenodo_community(community):
-    next_url = f"https://zenodo.org/api/communities/{community}/records"
-    # Go through the pages...
-    while next_url:
-        results_text = get_zenodo_url(next_url)
-        results = json.loads(results_text)
-        for hit in results["hits"].get("hits", []):
-            yield hit
-        next_url = results['links'].get('next', None)
+def get_zenodo_community(community, cache_for: int = None):
+    url = f"https://zenodo.org/api/communities/{community}/records?size={PAGE_SIZE}&sort=newest"
+    # The first page says how many pages there are...
+    results = json.loads(get_zenodo_url(f"{url}&page=1", cache_for))
+    total = results["hits"].get("total", 0)
+    # (Going by how many it actually returned, in case Zenodo gives out smaller pages than asked for)
+    page_size = len(results["hits"].get("hits", [])) or PAGE_SIZE
+    num_pages = max(1, math.ceil(total / page_size))
+    log.info(f"Zenodo community {community} has {total} records over {num_pages} pages.")
+    # ...so the rest can be fetched in parallel (the session backs off if we get rate-limited):
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        # (Copying the context so the fetches are counted against this source)
+        futures = [pool.submit(copy_context().run, get_zenodo_url, f"{url}&page={page}", cache_for) for page in range(2, num_pages + 1)]
+        pages = (future.result() for future in futures)
+        # Go through the pages, skipping any record that shifted onto the next page while fetching:
+        seen = set()
+        for page in itertools.chain([results], map(json.loads, pages)):
+            for hit in page["hits"].get("hits", []):
+                if hit["id"] in seen:
+                    continue
+                seen.add(hit["id"])
+                yield hit
+
+# The total and the most recent update time of a community change whenever its records do:
+def get_zenodo_community_version(community, cache_for: int = None):
+    results = json.loads(get_zenodo_url(f"https://zenodo.org/api/communities/{community}/records?size=1&sort=updated-desc", cache_for))
+    hits = results["hits"].get("hits", [])
+    latest = hits[0].get("updated", "") if hits else ""
+    return f"{results['hits'].get('total', 0)} {latest}"
 
 def parse_zenodo(config: Zenodo, result: SourceResults):
-    for hit in get_zenodo_community(config.community):
+    yield from parse_zenodo_hits(config, result, get_zenodo_community(config.community, config.cache_for))
+
+def zenodo_version(config: Zenodo) -> str:
+    return get_zenodo_community_version(config.community, config.cache_for)
+
+# Fetch all the pages of a community into the cache:
+def warm_zenodo(config: Zenodo):
+    for hit in get_zenodo_community(config.community, config.cache_for):
+        pass
+
+def parse_zenodo_hits(config: Zenodo, result: SourceResults, hits):
+    for hit in hits:
         #print(hit)
         md = hit['metadata']
         #print(md['publication_date'])
@@ -1,41 +1,121 @@
 import json
 import logging
+import threading
+import time
 from pyzotero import zotero
 from .models import IndexRecord, Zotero, SourceResults
-from .utils import cache, CACHE_FOR_SECONDS
+from .cache import get_cache
+from .stats import record_fetch
 
 
 # So we can see what's happening:
 log = logging.getLogger(__name__)
 
-# Caching call to Zotero:
-@cache.memoize(expire=CACHE_FOR_SECONDS)
-def get_zotero_collection(library_id: str, library_type: str, api_key: str, collection_id:str = None):
-    # Get the whole set of data from Zotero:
+# Get the current version of the library, which changes whenever anything in it does:
+def get_zotero_version(library_id: str, library_type: str, api_key: str) -> int:
     zot = zotero.Zotero(library_id, library_type, api_key)
-    items = zot.everything(zot.items())
-    # Get all collections and sub-collections, starting at the supplied ID or ALL if None: 
-    collections = zot.everything(zot.all_collections(collid=collection_id))
+    return zot.last_modified_version()
+
+# Only one sync of each local mirror at a time:
+sync_locks = {}
+
+# Keep a local mirror of a Zotero library, and bring it up to date by only fetching what changed since last time:
+def sync_zotero_library(library_id: str, library_type: str, api_key: str, cache_for: int = None):
+    cache = get_cache()
+    key = ("zotero-mirror", str(library_type), str(library_id))
+    start = time.perf_counter()
+    with sync_locks.setdefault(key, threading.Lock()):
+        mirror = cache.get(key, None) or { 'version': 0, 'items': {}, 'collections': {} }
+        zot = zotero.Zotero(library_id, library_type, api_key)
+        version = zot.last_modified_version()
+        since = mirror['version']
+        if version == since:
+            log.info(f"Zotero {library_type} library {library_id} is unchanged at version {version}.")
+            # Mirrors from older versions of awindex won't have the paths yet:
+            if 'paths' not in mirror:
+                mirror['paths'] = get_collection_paths(mirror['collections'])
+                cache.set(key, mirror, expire=cache_for)
+            record_fetch(time.perf_counter() - start, hit=True)
+            return mirror
+        log.info(f"Syncing Zotero {library_type} library {library_id} from version {since} to {version}...")
+        # Items moved to the trash are only reported if trashed items are included:
+        for item in zot.everything(zot.items(since=since, includeTrashed=1)):
+            if item['data'].get('deleted', False):
+                mirror['items'].pop(item['key'], None)
+            else:
+                mirror['items'][item['key']] = item
+        for c in zot.everything(zot.collections(since=since)):
+            if c['data'].get('deleted', False):
+                mirror['collections'].pop(c['key'], None)
+            else:
+                mirror['collections'][c['key']] = c
+        # Drop anything deleted since the last sync:
+        if since > 0:
+            deleted = zot.deleted(since=since)
+            for k in deleted.get('items', []):
+                mirror['items'].pop(k, None)
+            for k in deleted.get('collections', []):
+                mirror['collections'].pop(k, None)
+        mirror['version'] = version
+        mirror['paths'] = get_collection_paths(mirror['collections'])
+        cache.set(key, mirror, expire=cache_for)
+        record_fetch(time.perf_counter() - start)
+        log.info(f"Zotero library now holds {len(mirror['items'])} items and {len(mirror['collections'])} collections.")
+        return mirror
+
+def get_zotero_collection(library_id: str, library_type: str, api_key: str, collection_id:str = None, cache_for: int = None):
+    mirror = sync_zotero_library(library_id, library_type, api_key, cache_for)
+    # Most recently modified first, as the Zotero API does:
+    items = sorted(mirror['items'].values(), key=lambda item: item['data'].get('dateModified', ''), reverse=True)
+    # Get all collections and sub-collections, starting at the supplied ID or ALL if None:
+    collections = list(mirror['collections'].values())
+    if collection_id:
+        children = {}
+        for c in collections:
+            children.setdefault(c['data']['parentCollection'] or None, []).append(c)
+        collections = []
+        scope = [mirror['collections'][collection_id]] if collection_id in mirror['collections'] else []
+        while scope:
+            c = scope.pop()
+            collections.append(c)
+            scope.extend(children.get(c['key'], []))
     # And return
-    return items, collections
+    return items, collections, mirror['paths']
+
+# Resolve the full " > " separated path of every collection in one go:
+def get_collection_paths(collections: dict) -> dict:
+    paths = {}
+    for key in collections:
+        # Walk up the parents until reaching a known path, the top, a missing parent or a loop:
+        chain = []
+        k = key
+        while k in collections and k not in paths and k not in chain:
+            chain.append(k)
+            k = collections[k]['data']['parentCollection']
+        prefix = paths.get(k, None)
+        if k in chain:
+            log.warning(f"Zotero collection {k} is its own ancestor!")
+        # Then fill in the paths on the way back down:
+        for k in reversed(chain):
+            name = collections[k]['data']['name']
+            prefix = f"{prefix} > {name}" if prefix else name
+            paths[k] = prefix
+    return paths
+
+def zotero_version(source: Zotero) -> str:
+    return str(get_zotero_version(source.library_id, source.library_type, source.api_key))
 
-def get_full_collection(cols, c):
-    name = c['data']['name']
-    if c['data']['parentCollection']:
-        p = cols[c['data']['parentCollection']]
-        return f"{get_full_collection(cols, p)} > {name}"
-    else:
-        return name
-        
+def warm_zotero(source: Zotero):
+    sync_zotero_library(source.library_id, source.library_type, source.api_key, source.cache_for)
 
 def parse_zotero(source: Zotero, result: SourceResults):
-    # Get and cache the whole set of items and collections:
-    items, collections = get_zotero_collection(source.library_id, source.library_type, source.api_key, collection_id=source.collection_id)
+    # Get the whole set of items and collections from the local mirror:
+    items, collections, paths = get_zotero_collection(source.library_id, source.library_type, source.api_key, collection_id=source.collection_id, cache_for=source.cache_for)
+    yield from parse_zotero_items(source, result, items, collections, paths)
 
+def parse_zotero_items(source: Zotero, result: SourceResults, items, collections, paths):
     # Can index collections by key, and then can add collections as section facets:
-    cols = {}
-    for c in collections:
-        cols[c['key']] = c
+    cols = set(c['key'] for c in collections)
 
     # Convert to common format:
     count = 0
@@ -73,8 +153,7 @@ def parse_zotero(source: Zotero, result: SourceResults):
                 # Skip entries that are outside the requestions collection scope:
                 if not c_k in cols:
                     continue
-                c = cols[c_k]
-                sections.append(get_full_collection(cols, c))
+                sections.append(paths[c_k])
             ir.categories = sections
             
         # Skip items in no collections if a specific collection was requested: